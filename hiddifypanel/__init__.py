@@ -1,3 +1,4 @@
+from . import startup_profile  # first, to see the other imports
 from .VERSION import __version__, __release_date__
 # from . import cache
 from . import Events
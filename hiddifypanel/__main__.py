@@ -5,6 +5,7 @@ from . import create_app_wsgi
 
 
 @click.group(cls=FlaskGroup, create_app=create_app_wsgi,)
+@click.option('--profile-startup', is_flag=True, expose_value=False, help="Report the import and init time of each module (to stderr).")
 def main():
     pass
 
@@ -1,14 +1,39 @@
 
+import time
+from apiflask import abort
 from flask import g, redirect, request, session
+from flask_session.sessions import RedisSessionInterface
 from hiddifypanel.hutils.flask import hurl_for
 from flask_login.utils import _get_user
 from functools import wraps
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
 from hiddifypanel.models import *
+from hiddifypanel.models.config import listen_channel
+from hiddifypanel.cache import LocalCache, redis_client, redis_call
+from hiddifypanel import Events
 
 from hiddifypanel import hutils
 from werkzeug.local import LocalProxy
 current_account: "BaseAccount" = LocalProxy(lambda: _get_user())
 
+# each ip can have AUTH_BUCKET_SIZE unknown uuids, refilled by AUTH_BUCKET_RATE per second
+AUTH_BUCKET_SIZE = 20
+AUTH_BUCKET_RATE = 0.5
+rejected_uuids = LocalCache(maxsize=4096, ttl=60)  # (is_admin, uuid) of the recently unknown accounts
+limited_ips = LocalCache(maxsize=4096, ttl=10)
+USER_CHANGED_CHANNEL = "h:user-changed"
+__take_auth_token = redis_client.register_script('''
+local tokens = tonumber(redis.call('HGET', KEYS[1], 't') or ARGV[1])
+local updated = tonumber(redis.call('HGET', KEYS[1], 'u') or ARGV[3])
+tokens = math.min(tonumber(ARGV[1]), tokens + (tonumber(ARGV[3]) - updated) * tonumber(ARGV[2]))
+local allowed = tokens >= 1
+if allowed then tokens = tokens - 1 end
+redis.call('HSET', KEYS[1], 't', tokens, 'u', ARGV[3])
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[1]) / tonumber(ARGV[2])))
+return allowed and 1 or 0
+''')
+
 
 class AnonymousAccount(BaseAccount):
     __abstract__ = True
@@ -123,6 +148,66 @@ def get_account_by_uuid(uuid, is_admin):
     return AdminUser.by_uuid(f'{uuid}') if is_admin else User.by_uuid(f'{uuid}')
 
 
+def get_account_by_uuid_limited(uuid, is_admin):
+    '''get_account_by_uuid for the untrusted requests. The known accounts are always served, the recently unknown
+    uuids are rejected without a database query and the ips which sent too many unknown uuids get 429'''
+    key = (is_admin, f'{uuid}')
+    if not rejected_uuids.get(key):
+        if account := get_account_by_uuid(uuid, is_admin):
+            return account
+        rejected_uuids.set(key, True)
+    ip = f'{hutils.network.auto_ip_selector.get_real_user_ip()}'
+    if limited_ips.get(ip) or not take_auth_token(ip):
+        limited_ips.set(ip, True)
+        abort(429, "Too many requests")
+    return None
+
+
+def take_auth_token(ip) -> bool:
+    '''Allows the request while redis is unavailable'''
+    return bool(redis_call(lambda: __take_auth_token(keys=[f'h:auth-bucket:{ip}'], args=[AUTH_BUCKET_SIZE, AUTH_BUCKET_RATE, time.time()]), default=True))
+
+
+def forget_rejected_uuids(user=None, **kwargs):
+    publish_forget_rejected_uuid(f'{user.uuid}' if user is not None else '')
+
+
+def publish_forget_rejected_uuid(uuid: str):
+    '''The rejected uuids are cached in every worker, so the change is published to all of them, empty uuid forgets all'''
+    __forget_rejected_uuid(uuid)
+    redis_call(lambda: redis_client.publish(USER_CHANGED_CHANNEL, uuid))
+
+
+def __forget_rejected_uuid(uuid):
+    if uuid:
+        rejected_uuids.delete((False, uuid))
+        rejected_uuids.delete((True, uuid))
+    else:
+        rejected_uuids.clear()
+
+
+def __on_user_changed_message(data):
+    __forget_rejected_uuid(data.decode() if data else '')
+
+
+def __mark_admin_changed(mapper, connection, target):
+    if session := object_session(target):
+        session.info.setdefault('changed_admin_uuids', set()).add(f'{target.uuid}')
+
+
+@event.listens_for(Session, 'after_commit')
+def __forget_changed_admins(session):
+    '''The admin views and apis do not notify user_changed'''
+    for uuid in session.info.pop('changed_admin_uuids', ()):
+        publish_forget_rejected_uuid(uuid)
+
+
+Events.user_changed.subscribe(forget_rejected_uuids)
+listen_channel(USER_CHANGED_CHANNEL, __on_user_changed_message)
+event.listen(AdminUser, 'after_insert', __mark_admin_changed)
+event.listen(AdminUser, 'after_update', __mark_admin_changed)
+
+
 def login_by_uuid(uuid, is_admin: bool):
     account = get_account_by_uuid(uuid, is_admin)
     if not account:
@@ -139,7 +224,7 @@ def auth_before_request():
 
     if g.uuid:
         # print("uuid", g.uuid, is_admin_path)
-        account = get_account_by_uuid(g.uuid, is_admin_path)
+        account = get_account_by_uuid_limited(g.uuid, is_admin_path)
         # print(account)
         if not account:
             return logout_redirect()
@@ -148,7 +233,7 @@ def auth_before_request():
                                                                                                           '/admin/').replace("http://", "https://")
 
     elif apikey := request.headers.get("Hiddify-API-Key"):
-        account = get_account_by_api_key(apikey, is_admin_path)
+        account = get_account_by_uuid_limited(apikey, is_admin_path)  # api_key equals uuid for now
         if not account:
             return logout_redirect()
     elif request.authorization:
@@ -157,7 +242,7 @@ def auth_before_request():
         pword = request.authorization.password
         if not pword:
             # print("NO PASSWORD so it is uuid")
-            account = get_account_by_uuid(uname, is_admin_path)
+            account = get_account_by_uuid_limited(uname, is_admin_path)
         else:
             account = AdminUser.by_username_password(uname, pword) if is_admin_path else User.by_username_password(uname, pword)
         if not account:
@@ -178,12 +263,40 @@ def auth_before_request():
         g.__account_store = account
         # g.account_uuid = account.uuid
         g.is_admin = hutils.flask.is_admin_role(account.role)  # type: ignore
-        login_user(account, force=True)
+        if is_stateless_request():
+            g.stateless_auth = True
+        else:
+            login_user(account, force=True)
         # print("loggining in")
         if next_url is not None and g.user_agent['is_browser'] and ".webmanifest" not in request.path:
             return redirect(next_url)
 
 
+def is_stateless_request() -> bool:
+    '''Subscription clients do not keep the cookies, so a session would be created in redis on each of their polls'''
+    return not g.user_agent['is_browser'] and bool(request.endpoint) and '.UserView:' in request.endpoint
+
+
+_SESSION_UNAVAILABLE = object()
+
+
+class StatelessRedisSessionInterface(RedisSessionInterface):
+    '''Does not save the session of the stateless requests.
+    While redis is unavailable the requests get an empty session which is not saved, so the cookie is kept.'''
+
+    def open_session(self, app, request):
+        session = redis_call(lambda: super(StatelessRedisSessionInterface, self).open_session(app, request), default=_SESSION_UNAVAILABLE)
+        if session is _SESSION_UNAVAILABLE:
+            g.session_unavailable = True
+            session = self.session_class(sid=self._generate_sid(), permanent=self.permanent)
+        return session
+
+    def save_session(self, app, session, response):
+        if g.get('stateless_auth') or g.get('session_unavailable'):
+            return
+        redis_call(lambda: super(StatelessRedisSessionInterface, self).save_session(app, session, response))
+
+
 def logout_redirect():
     print(f"Incorrect user {current_account}.... loggining out")
     logout_user()
@@ -19,6 +19,7 @@ from hiddifypanel.cache import redis_client
 from hiddifypanel import auth
 from hiddifypanel.panel import hiddify
 from hiddifypanel import hutils
+from hiddifypanel import startup_profile
 
 
 def create_app(*args, cli=False, **config):
@@ -56,6 +57,7 @@ def create_app(*args, cli=False, **config):
     app.config['SESSION_PERMANENT'] = True
     app.config['PERMANENT_SESSION_LIFETIME'] = datetime.timedelta(days=10)
     Session(app)
+    app.session_interface = auth.StatelessRedisSessionInterface(redis_client, app.config['SESSION_KEY_PREFIX'], app.config['SESSION_USE_SIGNER'], app.config['SESSION_PERMANENT'])
     app.jinja_env.line_statement_prefix = '%'
     app.jinja_env.filters['b64encode'] = hutils.encode.do_base_64
     app.view_functions['admin.static'] = {}  # fix bug in apiflask
@@ -70,7 +72,7 @@ def create_app(*args, cli=False, **config):
         app.config[c] = v
 
     hiddifypanel.database.init_app(app)
-    with app.app_context():
+    with app.app_context(), startup_profile.step('init_db'):
         init_db()
  # flaskbabel = FlaskBabel(app)
 
@@ -86,13 +88,17 @@ def create_app(*args, cli=False, **config):
         return g.locale
     babel = Babel(app, locale_selector=get_locale)
 
-    hiddifypanel.panel.common.init_app(app)
-    hiddifypanel.panel.common_bp.init_app(app)
+    with startup_profile.step('common'):
+        hiddifypanel.panel.common.init_app(app)
+        hiddifypanel.panel.common_bp.init_app(app)
 
     from hiddifypanel.panel import user, commercial, admin
-    admin.init_app(app)
-    user.init_app(app)
-    commercial.init_app(app)
+    with startup_profile.step('admin'):
+        admin.init_app(app)
+    with startup_profile.step('user'):
+        user.init_app(app)
+    with startup_profile.step('commercial'):
+        commercial.init_app(app)
 
     app.config.update(config)  # Override with passed config
     # app.config['WTF_CSRF_CHECK_DEFAULT'] = False
@@ -118,6 +124,7 @@ def create_app(*args, cli=False, **config):
     app.jinja_env.globals['get_locale'] = get_locale
 
     hiddifypanel.panel.cli.init_app(app)
+    startup_profile.report()
     return app
 
 
@@ -1,8 +1,15 @@
 from redis_cache import RedisCache
+from collections import OrderedDict
 from functools import wraps
+import threading
+import time
 import redis
+from flask import g, has_app_context
 from pickle import dumps, loads
-redis_client = redis.from_url('unix:///opt/hiddify-manager/other/redis/run.sock?db=0')
+REDIS_URL = 'unix:///opt/hiddify-manager/other/redis/run.sock?db=0'
+REDIS_TIMEOUT = 1  # seconds, bounds the requests while redis is slow or restarting
+redis_client = redis.from_url(REDIS_URL, socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT)
+redis_pubsub_client = redis.from_url(REDIS_URL)  # subscribers block on reads, so no timeout
 
 
 def exception_handler(e, original_fn, args, kwargs):
@@ -11,9 +18,304 @@ def exception_handler(e, original_fn, args, kwargs):
     pass
 
 
+CACHE_STATS_KEY = "h:cache-stats"
+CACHE_STATS_FIELDS = ('hits', 'misses', 'exceptions', 'fallbacks', 'redis_seconds', 'payload_bytes')
+CACHE_STATS_FLUSH_INTERVAL = 10
+CACHE_GENERATIONS_KEY = "h:cache-generations"
+DEFAULT_CACHE_TTL = 24 * 3600  # for the functions without ttl, so the entries of the old generations expire too
+FALLBACK_CACHE_SIZE = 256
+FALLBACK_CACHE_TTL = 60
+
+
+class CircuitBreaker:
+    '''Opens after `threshold` consecutive failures, then lets one call try again every `retry_after` seconds'''
+
+    def __init__(self, threshold: int = 3, retry_after: float = 5):
+        self.threshold = threshold
+        self.retry_after = retry_after
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self.on_close = []
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        with self._lock:
+            if time.monotonic() - self.opened_at < self.retry_after:
+                return False
+            self.opened_at = time.monotonic()  # the other calls wait for this trial
+            return True
+
+    def success(self):
+        if self.opened_at is None and not self.failures:
+            return
+        with self._lock:
+            was_open = self.opened_at is not None
+            self.failures = 0
+            self.opened_at = None
+        if was_open:
+            print("redis is healthy again, closing the cache circuit breaker")
+            for callback in self.on_close:
+                callback()
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is None and self.failures < self.threshold:
+                return
+            if self.opened_at is None:
+                self.trips += 1
+                print("redis is unhealthy, the cache falls back to the local store")
+            self.opened_at = time.monotonic()
+
+
+redis_breaker = CircuitBreaker()
+
+
+def redis_call(fn, default=None):
+    '''Calls fn, which uses redis, through redis_breaker. Returns default while redis is unhealthy or if fn fails'''
+    if not redis_breaker.allow():
+        return default
+    try:
+        res = fn()
+    except redis.RedisError as e:
+        print("redis exception occur", e)
+        redis_breaker.failure()
+        return default
+    redis_breaker.success()
+    return res
+
+
+class CacheStats:
+    '''Counters of one cached function, kept per process and added to a shared redis hash every few seconds'''
+
+    def __init__(self, name: str):
+        self.name = name
+        self.counters = dict.fromkeys(CACHE_STATS_FIELDS, 0)
+        self.flushed_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, **values):
+        with self.lock:
+            for field, v in values.items():
+                self.counters[field] += v
+            if time.monotonic() - self.flushed_at < CACHE_STATS_FLUSH_INTERVAL or redis_breaker.is_open:
+                return
+            counters, self.counters = self.counters, dict.fromkeys(CACHE_STATS_FIELDS, 0)
+            self.flushed_at = time.monotonic()
+        try:
+            pipe = redis_client.pipeline()
+            for field, v in counters.items():
+                if v:
+                    pipe.hincrbyfloat(CACHE_STATS_KEY, f'{self.name}|{field}', v)
+            pipe.execute()
+        except Exception as e:
+            print("cache stats exception occur", e, self.name)
+
+
+class InstrumentedRedisCache(RedisCache):
+    '''RedisCache which records hits, misses, redis latency, payload size and exceptions of each decorated function.
+    The redis latency includes the (de)serialization of the payload.
+
+    The keys of each function contain its generation, so invalidate_all is a single HINCRBY instead of a
+    scan of the keyspace and the old entries expire by their ttl (DEFAULT_CACHE_TTL if not given).
+
+    While redis fails, redis_breaker is open and the functions are cached in a bounded LocalCache of the process.'''
+
+    def __init__(self, *args, serializer=dumps, deserializer=loads, **kwargs):
+        self._state = threading.local()
+        self._key_serializer = serializer
+        super().__init__(*args, serializer=self._sized(serializer), deserializer=self._sized(deserializer), key_serializer=self._generation_key, **kwargs)
+        self.stats = {}
+        self._pending_bumps = set()  # invalidate_all calls which did not reach redis
+        redis_breaker.on_close.append(self._bump_pending_generations)
+
+    def _generation_key(self, args):
+        return self._key_serializer((getattr(self._state, 'generation', 0), args))
+
+    def get_generation(self, name: str) -> int:
+        '''The generations are read from redis once per request'''
+        if has_app_context():
+            if 'cache_generations' not in g:
+                g.cache_generations = {k.decode(): int(v) for k, v in redis_client.hgetall(CACHE_GENERATIONS_KEY).items()}
+            return g.cache_generations.get(name, 0)
+        return int(redis_client.hget(CACHE_GENERATIONS_KEY, name) or 0)
+
+    def bump_generation(self, name: str):
+        if redis_breaker.allow():
+            try:
+                generation = redis_client.hincrby(CACHE_GENERATIONS_KEY, name, 1)
+                redis_breaker.success()
+                if has_app_context() and 'cache_generations' in g:
+                    g.cache_generations[name] = generation
+                return
+            except redis.RedisError as e:
+                print("cache exception occur", e, name)
+                redis_breaker.failure()
+        self._pending_bumps.add(name)
+
+    def _bump_pending_generations(self):
+        while self._pending_bumps:
+            self.bump_generation(self._pending_bumps.pop())
+
+    def _sized(self, fn):
+        @wraps(fn)
+        def inner(data):
+            res = fn(data)
+            self._state.payload_bytes = len(data if isinstance(data, (bytes, str)) else res)
+            return res
+        return inner
+
+    def cache(self, ttl=0, limit=0, namespace=None, exception_handler=None):
+        ttl = ttl or DEFAULT_CACHE_TTL
+        decorator = super().cache(ttl=ttl, limit=limit, namespace=namespace, exception_handler=exception_handler)
+
+        def wrapper(fn):
+            name = f'{fn.__module__}.{fn.__qualname__}'
+            stats = self.stats.setdefault(name, CacheStats(name))
+            state = self._state
+            fallback = LocalCache(maxsize=FALLBACK_CACHE_SIZE, ttl=min(ttl, FALLBACK_CACHE_TTL))
+
+            @wraps(fn)
+            def original(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    state.result = fn(*args, **kwargs)
+                    return state.result
+                finally:
+                    state.fn_seconds = time.perf_counter() - start
+
+            cached = decorator(original)
+
+            def from_fallback(args, kwargs):
+                stats.add(fallbacks=1)
+                if state.fn_seconds is not None:  # redis failed after the call
+                    return state.result
+                key = self._key_serializer((args, sorted(kwargs.items())))
+                res = fallback.get(key, fallback)
+                if res is fallback:
+                    res = fn(*args, **kwargs)
+                    fallback.set(key, res)
+                return res
+
+            @wraps(fn)
+            def inner(*args, **kwargs):
+                state.fn_seconds = None
+                state.payload_bytes = 0
+                if not redis_breaker.allow():
+                    return from_fallback(args, kwargs)
+                start = time.perf_counter()
+                try:
+                    state.generation = self.get_generation(name)
+                    res = cached(*args, **kwargs)
+                    redis_breaker.success()
+                except redis.RedisError as e:
+                    print("cache exception occur", e, name)
+                    redis_breaker.failure()
+                    return from_fallback(args, kwargs)
+                except BaseException:
+                    stats.add(exceptions=1)
+                    raise
+                elapsed = time.perf_counter() - start
+                miss = state.fn_seconds is not None
+                stats.add(hits=0 if miss else 1, misses=1 if miss else 0,
+                          redis_seconds=elapsed - (state.fn_seconds or 0), payload_bytes=state.payload_bytes)
+                return res
+
+            def invalidate(*args, **kwargs):
+                fallback.delete(self._key_serializer((args, sorted(kwargs.items()))))
+                state.generation = self.get_generation(name)
+                return cached.invalidate(*args, **kwargs)
+
+            def invalidate_all():
+                fallback.clear()
+                self.bump_generation(name)
+
+            inner.invalidate = invalidate
+            inner.invalidate_all = invalidate_all
+            inner.instance = getattr(cached, 'instance', None)
+            return inner
+        return wrapper
+
+
+def get_cache_stats() -> dict:
+    '''Returns {function: {hits, misses, exceptions, redis_seconds, payload_bytes, hit_rate, avg_redis_ms, avg_payload_bytes}} of all the workers'''
+    res = {}
+    for field, v in redis_client.hgetall(CACHE_STATS_KEY).items():
+        name, _, field = field.decode().rpartition('|')
+        res.setdefault(name, dict.fromkeys(CACHE_STATS_FIELDS, 0))[field] = float(v)
+    for stats in res.values():
+        calls = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / calls if calls else 0
+        stats['avg_redis_ms'] = stats['redis_seconds'] * 1000 / calls if calls else 0
+        stats['avg_payload_bytes'] = stats['payload_bytes'] / calls if calls else 0
+    return res
+
+
+def get_cache_stats_prometheus() -> str:
+    all_stats = get_cache_stats()
+    res = []
+    for field in CACHE_STATS_FIELDS:
+        res.append(f'# TYPE hiddify_cache_{field}_total counter')
+        for name, stats in all_stats.items():
+            res.append(f'hiddify_cache_{field}_total{{function="{name}"}} {stats[field]}')
+    return "\n".join(res) + "\n"
+
+
+def reset_cache_stats():
+    redis_client.delete(CACHE_STATS_KEY)
+
+
 # cache = RedisCache(redis_client=redis_client, exception_handler=exception_handler)
 # cache = RedisCache(redis_client=redis_client, prefix="h", serializer=dumps, deserializer=loads, exception_handler=exception_handler)
-cache = RedisCache(redis_client=redis_client, prefix="h", serializer=dumps, deserializer=loads)
+cache = InstrumentedRedisCache(redis_client=redis_client, prefix="h", serializer=dumps, deserializer=loads)
+
+
+class LocalCache:
+    '''Bounded in-process LRU store with an optional per-entry ttl (seconds, 0 means no expiry)'''
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expire, value = item
+            if expire and expire < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float | None = None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl if ttl else 0, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
 
 
 class CacheDecorator:
@@ -5,3 +5,25 @@ class DriverABS:
     def get_enabled_users(self): pass
     def add_client(self, user): pass
     def remove_client(self, user): pass
+
+    def add_clients(self, users):
+        for user in users:
+            self.add_client(user)
+
+    def remove_clients(self, users):
+        for user in users:
+            self.remove_client(user)
+
+
+def parse_user_traffic_stats(stats) -> dict:
+    '''Sums the user>>>{uuid}@hiddify.com>>>traffic>>>{downlink|uplink} counters of a stats query into {uuid: bytes}'''
+    res = {}
+    for stat in stats:
+        if not stat.value:
+            continue
+        parts = stat.name.split('>>>')
+        if len(parts) != 4 or parts[0] != 'user' or parts[2] != 'traffic':
+            continue
+        uuid = parts[1].split('@')[0]
+        res[uuid] = res.get(uuid, 0) + stat.value
+    return res
@@ -1,23 +1,34 @@
-import xtlsapi
 from hiddifypanel.models import *
-from .abstract_driver import DriverABS
+from .abstract_driver import DriverABS, parse_user_traffic_stats
 from flask import current_app
 import json
+import os
 
 
 class SingboxApi(DriverABS):
+    def __init__(self):
+        self._enabled_users = None  # ((path, mtime), users) of the last parsed api config
+
     def get_singbox_client(self):
         if hconfig(ConfigEnum.is_parent):
             return
+        import xtlsapi  # loaded on first use, it is slow to import
         return xtlsapi.SingboxClient('127.0.0.1', 10086)
 
     def get_enabled_users(self):
         if hconfig(ConfigEnum.is_parent):
             return
         config_dir = current_app.config['HIDDIFY_CONFIG_PATH']
-        with open(f"{config_dir}/singbox/configs/01_api.json") as f:
+        path = f"{config_dir}/singbox/configs/01_api.json"
+        # the file is only rewritten when the users are applied, so it is parsed again only when it changes
+        mtime = os.stat(path).st_mtime_ns
+        if self._enabled_users and self._enabled_users[0] == (path, mtime):
+            return self._enabled_users[1]
+        with open(path) as f:
             json_data = json.load(f)
-            return {u.split("@")[0]: 1 for u in json_data['experimental']['v2ray_api']['stats']['users']}
+            users = {u.split("@")[0]: 1 for u in json_data['experimental']['v2ray_api']['stats']['users']}
+        self._enabled_users = ((path, mtime), users)
+        return users
         # raise NotImplementedError()
 #
 
@@ -44,7 +55,21 @@ class SingboxApi(DriverABS):
         # raise NotImplementedError()
 
     def get_all_usage(self, users):
-        return {u: self.get_usage_imp(u.uuid) for u in users}
+        singbox_client = self.get_singbox_client()
+        if not singbox_client:
+            return {}
+        try:
+            # one rpc for the counters of all the users instead of two per user
+            usages = parse_user_traffic_stats(singbox_client.stats_query('user>>>', reset=True))
+        except Exception as e:
+            print(f"error in get singbox usage {e}")
+            return {}
+        res = {}
+        for u in users:
+            if usage := usages.get(u.uuid):
+                res[u] = usage
+        print(f"singbox usage of {len(res)} users sum={sum(res.values())}")
+        return res
 
     def get_usage_imp(self, uuid):
         xray_client = self.get_singbox_client()
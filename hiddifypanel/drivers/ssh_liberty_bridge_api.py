@@ -20,19 +20,48 @@ class SSHLibertyBridgeApi(DriverABS):
         return {m.split("::")[0]: 1 for m in members}
 
     def add_client(self, user):
-        print(f'Adding SSH {user}')
+        self.add_clients([user])
+
+    def add_clients(self, users):
+        print(f'Adding {len(users)} SSH users')
         redis_client = self.get_ssh_redis_client()
-        redis_client.sadd(USERS_SET, f'{user.uuid}::{user.ed25519_public_key}')
-        redis_client.save()
+        redis_client.sadd(USERS_SET, *[f'{user.uuid}::{user.ed25519_public_key}' for user in users])
+        self.persist(redis_client)
 
     def remove_client(self, user):
+        self.remove_clients([user])
+
+    def remove_clients(self, users):
         redis_client = self.get_ssh_redis_client()
-        redis_client.srem(USERS_SET, f'{user.uuid}::{user.ed25519_public_key}')
-        redis_client.hdel(USERS_USAGE, f'{user.uuid}')
-        redis_client.save()
+        pipe = redis_client.pipeline()
+        pipe.srem(USERS_SET, *[f'{user.uuid}::{user.ed25519_public_key}' for user in users])
+        pipe.hdel(USERS_USAGE, *[f'{user.uuid}' for user in users])
+        pipe.execute()
+        self.persist(redis_client)
+
+    def persist(self, redis_client):
+        '''A background save instead of a blocking dump of the whole db'''
+        try:
+            redis_client.bgsave()
+        except redis.ResponseError as e:  # a background save is already in progress
+            print(f'ssh redis bgsave {e}')
 
     def get_all_usage(self, users):
-        return {u: self.get_usage_imp(u.uuid) for u in users}
+        redis_client = self.get_ssh_redis_client()
+        usages = redis_client.hgetall(USERS_USAGE)
+        res = {}
+        # the read values are subtracted in one transaction, so the traffic counted meanwhile is kept
+        pipe = redis_client.pipeline(transaction=True)
+        for u in users:
+            value = int(usages.get(f'{u.uuid}') or 0)
+            if value:
+                pipe.hincrby(USERS_USAGE, f'{u.uuid}', -value)
+                res[u] = value
+        print(f'ssh usage of {len(res)} users sum={sum(res.values())}')
+        if res:
+            pipe.execute()
+            self.persist(redis_client)
+        return res
 
     def get_usage_imp(self, client_uuid: str, reset: bool = True) -> int:
         redis_client = self.get_ssh_redis_client()
@@ -45,7 +74,7 @@ class SSHLibertyBridgeApi(DriverABS):
 
         if reset:
             redis_client.hincrby(USERS_USAGE, client_uuid, -value)
-            redis_client.save()
+            self.persist(redis_client)
         if value:
             print(f'ssh usage {client_uuid} {value}')
         return value
@@ -1,3 +1,11 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+import copy
+import os
+import threading
+import time
+from flask import current_app, g
+from hiddifypanel.cache import redis_client, redis_call
 from .ssh_liberty_bridge_api import SSHLibertyBridgeApi
 from .xray_api import XrayApi
 from .singbox_api import SingboxApi
@@ -6,33 +14,184 @@ from hiddifypanel.models import *
 from hiddifypanel.panel import hiddify
 drivers = [XrayApi(), SingboxApi(), SSHLibertyBridgeApi(), WireguardApi()]
 
+DRIVER_TIMEOUT = 30  # seconds for all the drivers to answer, can be changed by DRIVER_TIMEOUT in app.cfg
+# usage read (and reset) by the drivers after the deadline, added to the next cycle
+LATE_USAGE_KEY = "h:late-usage"
+# the read only polls are skipped while their previous call is running, the changes of the users always run
+POLL_METHODS = ['get_all_usage', 'get_enabled_users']
+# the fields of the users used by the drivers, the threads should not touch the db objects of the caller
+DriverUser = namedtuple('DriverUser', ['id', 'uuid', 'wg_pub', 'ed25519_public_key'])
 
-def get_users_usage(reset=True):
+# driver -> {calls, errors, timeouts, late, last_seconds, total_seconds, last_error} of this process
+driver_stats = {d.__class__.__name__: {'calls': 0, 'errors': 0, 'timeouts': 0, 'late': 0, 'last_seconds': 0, 'total_seconds': 0, 'last_error': None} for d in drivers}
+_stats_lock = threading.Lock()
+_running = set()  # (driver, method) of the polls which did not finish yet
+_executor = None
+_pid = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    '''Threads do not survive the fork of the workers, so every process starts its own.
+    The interpreter waits for the running calls on exit, so the late usage of the cli is saved too.'''
+    global _executor, _pid
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        _running.clear()
+        _executor = ThreadPoolExecutor(max_workers=2 * len(drivers), thread_name_prefix="user-driver")
+    return _executor
+
+
+def _record(name, **values):
+    with _stats_lock:
+        stats = driver_stats[name]
+        for k, v in values.items():
+            if k in ['last_seconds', 'last_error']:
+                stats[k] = v
+            else:
+                stats[k] += v
+
+
+def get_driver_stats() -> dict:
+    with _stats_lock:
+        return copy.deepcopy(driver_stats)
+
+
+def to_driver_users(users) -> list[DriverUser]:
+    return [DriverUser(u.id, u.uuid, u.wg_pub, u.ed25519_public_key) for u in users]
+
+
+def new_deadline() -> float:
+    '''The deadline of a cycle, shared by all the calls of the drivers in it'''
+    return time.monotonic() + (current_app.config.get('DRIVER_TIMEOUT') or DRIVER_TIMEOUT)
+
+
+def _run_drivers(method: str, *args, on_late=None, deadline=None) -> dict:
+    '''
+    Calls the method of all the drivers in parallel and returns {driver: result} of the ones which succeeded
+    before the deadline (a new one if not given). The result of a driver which finishes after the deadline is passed to on_late(driver, result).
+    A driver is not polled again while its previous poll is running.
+    '''
+    app = current_app._get_current_object()
+    timeout = max(0, (deadline or new_deadline()) - time.monotonic())
+    poll = method in POLL_METHODS
+    child_id = Child.current.id
+    lock = threading.Lock()
+    results = {}
+    abandoned = False
+
+    def run(driver):
+        name = driver.__class__.__name__
+        start = time.monotonic()
+        try:
+            with app.app_context():
+                g.child = Child.by_id(child_id)
+                res = getattr(driver, method)(*args)
+        except Exception as e:
+            res = e
+        finally:
+            if poll:
+                _running.discard((name, method))
+            elapsed = time.monotonic() - start
+            _record(name, calls=1, last_seconds=elapsed, total_seconds=elapsed)
+        with lock:
+            if not abandoned:
+                results[driver] = res
+                return
+        if isinstance(res, Exception):
+            hiddify.error(f'ERROR! {name} has error {res} in {method} after the deadline')
+        elif on_late:
+            _record(name, late=1)
+            on_late(driver, res)
+
+    futures = []
+    skipped = []
+    for driver in drivers:
+        name = driver.__class__.__name__
+        if poll:
+            if (name, method) in _running:
+                hiddify.error(f'ERROR! {name} is still running the previous {method}')
+                skipped.append(driver)
+                continue
+            _running.add((name, method))
+        futures.append(_get_executor().submit(run, driver))
+    wait(futures, timeout=timeout)
+    with lock:
+        abandoned = True
+        done = dict(results)
+
+    res = {}
+    for driver in drivers:
+        name = driver.__class__.__name__
+        if driver in skipped:
+            continue
+        if driver not in done:
+            _record(name, timeouts=1)
+            hiddify.error(f'ERROR! {name} did not finish {method} in {timeout:.1f}s')
+        elif isinstance(done[driver], Exception):
+            _record(name, errors=1, last_error=f'{done[driver]}')
+            hiddify.error(f'ERROR! {name} has error {done[driver]} in {method}')
+        else:
+            res[driver] = done[driver]
+    return res
+
+
+def _save_late_usage(driver, all_usage):
+    usages = {u.uuid: usage for u, usage in (all_usage or {}).items() if usage}
+    if not usages:
+        return
+
+    def save():
+        pipe = redis_client.pipeline()
+        for uuid, usage in usages.items():
+            pipe.hincrby(LATE_USAGE_KEY, uuid, usage)
+        pipe.execute()
+        return True
+    if not redis_call(save):
+        hiddify.error(f'ERROR! {driver.__class__.__name__} late usage of {len(usages)} users is lost: {usages}')
+
+
+def _pop_late_usage() -> dict:
+    def pop():
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.hgetall(LATE_USAGE_KEY)
+        pipe.delete(LATE_USAGE_KEY)
+        return pipe.execute()[0]
+    return {uuid.decode(): int(usage) for uuid, usage in (redis_call(pop) or {}).items()}
+
+
+def _failed_drivers(res: dict) -> list[str]:
+    return [d.__class__.__name__ for d in drivers if d not in res]
+
+
+def get_users_usage(reset=True, deadline=None):
     res = {}
     users = list(User.query.all())
     res = {u: {'usage': 0, 'ips': ''} for u in users}
-    for driver in drivers:
-        all_usage = driver.get_all_usage(users)
-        for user, usage in all_usage.items():
-            if usage:
-                res[user]['usage'] += usage
+    by_uuid = {u.uuid: u for u in users}
+    for driver, all_usage in _run_drivers('get_all_usage', to_driver_users(users), on_late=_save_late_usage, deadline=deadline).items():
+        for user, usage in (all_usage or {}).items():
+            if usage and user.uuid in by_uuid:
+                res[by_uuid[user.uuid]]['usage'] += usage
             # res[user]['ip'] +=usage
+    for uuid, usage in _pop_late_usage().items():
+        if uuid in by_uuid:
+            res[by_uuid[uuid]]['usage'] += usage
     return res
 
 
-def get_enabled_users():
+def get_enabled_users(deadline=None):
     from collections import defaultdict
     d = defaultdict(int)
     total = 0
-    for driver in drivers:
-        try:
-            for u, v in driver.get_enabled_users().items():
-                if not v:
-                    continue
-                d[u] += 1
-            total += 1
-        except Exception as e:
+    for driver, enabled_users in _run_drivers('get_enabled_users', deadline=deadline).items():
+        if enabled_users is None:
             hiddify.error(f'ERROR! {driver.__class__.__name__} has error in get_enabled users')
+            continue
+        for u, v in enabled_users.items():
+            if not v:
+                continue
+            d[u] += 1
+        total += 1
 
     res = defaultdict(bool)
     for u, v in d.items():
@@ -40,17 +199,22 @@ def get_enabled_users():
     return res
 
 
-def add_client(user: User):
-    for driver in drivers:
-        try:
-            driver.add_client(user)
-        except Exception as e:
-            hiddify.error(f'ERROR! {driver.__class__.__name__} has error {e} in add client for user={user.uuid}')
+# the changes of the users return the name of the drivers which failed or did not finish before the deadline
+def add_client(user: User, deadline=None) -> list[str]:
+    return _failed_drivers(_run_drivers('add_client', *to_driver_users([user]), deadline=deadline))
 
 
-def remove_client(user: User):
-    for driver in drivers:
-        try:
-            driver.remove_client(user)
-        except Exception as e:
-            hiddify.error(f'ERROR! {driver.__class__.__name__} has error {e} in remove client for user={user.uuid}')
+def remove_client(user: User, deadline=None) -> list[str]:
+    return _failed_drivers(_run_drivers('remove_client', *to_driver_users([user]), deadline=deadline))
+
+
+def add_clients(users: list[User], deadline=None) -> list[str]:
+    if not users:
+        return []
+    return _failed_drivers(_run_drivers('add_clients', to_driver_users(users), deadline=deadline))
+
+
+def remove_clients(users: list[User], deadline=None) -> list[str]:
+    if not users:
+        return []
+    return _failed_drivers(_run_drivers('remove_clients', to_driver_users(users), deadline=deadline))
@@ -1,24 +1,81 @@
-import xtlsapi
+import redis
+from hiddifypanel.cache import redis_client, redis_call
 from hiddifypanel.models import *
-from .abstract_driver import DriverABS
+from .abstract_driver import DriverABS, parse_user_traffic_stats
+
+ENABLED_USERS_KEY = "h:xray-enabled-users"
+RECONCILED_KEY = "h:xray-enabled-users:reconciled"
+TRAFFIC_USERS_KEY = "h:xray-traffic-users"  # users with traffic in the usage polls since the last reconcile
+SEED_MEMBER = "-"  # keeps the registry existing when no user is enabled
+RECONCILE_INTERVAL = 600
 
 
 class XrayApi(DriverABS):
     def get_xray_client(self):
         if hconfig(ConfigEnum.is_parent):
             return
+        import xtlsapi  # loaded on first use, it is slow to import
         return xtlsapi.XrayClient('127.0.0.1', 10085)
 
     def get_enabled_users(self):
         if hconfig(ConfigEnum.is_parent):
             return
-        xray_client = self.get_xray_client()
         users = User.query.all()
+        try:
+            enabled = self.get_registry(users)
+        except redis.RedisError as e:
+            print(f"error in xray enabled users registry {e}")
+            return self.probe_enabled_users(self.get_xray_client(), [u.uuid for u in users])
+        return {u.uuid: int(u.uuid in enabled) for u in users}
+
+    def get_registry(self, users) -> set:
+        '''The uuids added to xray, reconciled with xray at most every RECONCILE_INTERVAL seconds'''
+        pipe = redis_client.pipeline()
+        pipe.smembers(ENABLED_USERS_KEY)
+        pipe.exists(ENABLED_USERS_KEY)
+        pipe.exists(RECONCILED_KEY)
+        members, exists, reconciled = pipe.execute()
+        enabled = {m.decode() for m in members} - {SEED_MEMBER}
+        if not reconciled or not exists:
+            enabled = self.reconcile(enabled, users, seed=not exists)
+        return enabled
+
+    def reconcile(self, enabled: set, users, seed: bool = False) -> set:
+        '''Probes only the users whose registry state is doubtful: the users with traffic in the usage polls
+        which are not registered, and the registered users which are not active (e.g. dropped by a restart of xray).
+        An empty registry is seeded by probing all the users. It is retried on the next poll if xray fails.'''
+        xray_client = self.get_xray_client()
+        # the usage polls reset the xray counters, so the users with traffic are collected by get_all_usage
+        with_traffic = {m.decode() for m in redis_client.smembers(TRAFFIC_USERS_KEY)}
+        if seed:
+            suspects = {u.uuid for u in users}
+        else:
+            inactive = {u.uuid for u in users if not u.is_active}
+            suspects = (with_traffic - enabled) | (enabled & inactive)
+        probed = self.probe_enabled_users(xray_client, suspects)
+        added = [uuid for uuid, v in probed.items() if v == 1]
+        removed = [uuid for uuid, v in probed.items() if v == 0]
+        failed = len(probed) - len(added) - len(removed)
+        pipe = redis_client.pipeline()
+        if added or not failed:  # a failed seed is not marked as seeded
+            pipe.sadd(ENABLED_USERS_KEY, *added, *([SEED_MEMBER] if not failed else []))
+        if removed:
+            pipe.srem(ENABLED_USERS_KEY, *removed)
+        if not failed:
+            if with_traffic:
+                pipe.srem(TRAFFIC_USERS_KEY, *with_traffic)
+            pipe.set(RECONCILED_KEY, 1, ex=RECONCILE_INTERVAL)
+        pipe.execute()
+        print(f"Xray registry reconciled: probed={len(probed)} added={len(added)} removed={len(removed)} failed={failed}")
+        return (enabled | set(added)) - set(removed)
+
+    def probe_enabled_users(self, xray_client, uuids) -> dict:
+        '''Checks by adding and removing a client, which fails if the user is already in xray'''
+        import xtlsapi
         t = "xtls"
         protocol = "vless"
         enabled = {}
-        for u in users:
-            uuid = u.uuid
+        for uuid in uuids:
             try:
                 xray_client.add_client(t, f'{uuid}', f'{uuid}@hiddify.com', protocol=protocol, flow='xtls-rprx-vision', alter_id=0, cipher='chacha20_poly1305')
                 xray_client.remove_client(t, f'{uuid}@hiddify.com')
@@ -30,6 +87,24 @@ class XrayApi(DriverABS):
                 enabled[uuid] = e
         return enabled
 
+    def register(self, added=(), removed=()):
+        try:
+            pipe = redis_client.pipeline()
+            if added:
+                pipe.sadd(ENABLED_USERS_KEY, *added)
+            if removed:
+                pipe.srem(ENABLED_USERS_KEY, *removed)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"error in xray enabled users registry {e}")  # fixed by the next reconcile
+
+    def remember_traffic(self, uuids):
+        '''Used by reconcile, kept a bit longer than the reconcile interval if it is not called'''
+        pipe = redis_client.pipeline()
+        pipe.sadd(TRAFFIC_USERS_KEY, *uuids)
+        pipe.expire(TRAFFIC_USERS_KEY, 2 * RECONCILE_INTERVAL)
+        pipe.execute()
+
     def get_inbound_tags(self):
         if hconfig(ConfigEnum.is_parent):
             return
@@ -43,11 +118,19 @@ class XrayApi(DriverABS):
         return list(set(inbounds))
 
     def add_client(self, user):
+        self.add_clients([user])
+
+    def add_clients(self, users):
         if hconfig(ConfigEnum.is_parent):
             return
-        uuid = user.uuid
         xray_client = self.get_xray_client()
         tags = self.get_inbound_tags()
+        added = [user.uuid for user in users if self.add_client_to_tags(xray_client, tags, user.uuid)]
+        self.register(added=added)
+
+    def add_client_to_tags(self, xray_client, tags, uuid) -> bool:
+        import xtlsapi
+        success = False
         proto_map = {
             'vless': 'vless',
             'realityin': 'vless',
@@ -79,15 +162,26 @@ class XrayApi(DriverABS):
                     xray_client.add_client(t, f'{uuid}', f'{uuid}@hiddify.com', protocol=protocol,
                                            flow='xtls-rprx-vision', alter_id=0, cipher='chacha20_poly1305')
                 # print(f"Success add  {uuid} {t}")
+                success = True
+            except xtlsapi.xtlsapi.exceptions.EmailAlreadyExists:
+                success = True
             except Exception as e:
                 # print(f"error in add  {uuid} {t} {e}")
                 pass
+        return success
 
     def remove_client(self, user):
-        uuid = user.uuid
+        self.remove_clients([user])
+
+    def remove_clients(self, users):
         xray_client = self.get_xray_client()
         tags = self.get_inbound_tags()
+        for user in users:
+            self.remove_client_from_tags(xray_client, tags, user.uuid)
+        # removing a missing client fails too, so the users are not in xray either way
+        self.register(removed=[user.uuid for user in users])
 
+    def remove_client_from_tags(self, xray_client, tags, uuid):
         for t in tags:
             try:
                 xray_client.remove_client(t, f'{uuid}@hiddify.com')
@@ -97,7 +191,23 @@ class XrayApi(DriverABS):
                 pass
 
     def get_all_usage(self, users):
-        return {u: self.get_usage_imp(u.uuid) for u in users}
+        xray_client = self.get_xray_client()
+        if not xray_client:
+            return {}
+        try:
+            # one rpc for the counters of all the users instead of two per user
+            usages = parse_user_traffic_stats(xray_client.stats_query('user>>>', reset=True))
+        except Exception as e:
+            print(f"error in get xray usage {e}")
+            return {}
+        if usages:
+            redis_call(lambda: self.remember_traffic(usages))
+        res = {}
+        for u in users:
+            if usage := usages.get(u.uuid):
+                res[u] = usage
+        print(f"Xray usage of {len(res)} users sum={sum(res.values())}")
+        return res
 
     def get_usage_imp(self, uuid):
         xray_client = self.get_xray_client()
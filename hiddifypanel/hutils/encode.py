@@ -2,6 +2,7 @@ import urllib.parse
 import base64
 import uuid
 import string
+from typing import Iterable, Iterator
 from slugify import slugify
 
 
@@ -18,6 +19,19 @@ def do_base_64(input: str) -> str:
     return resp.decode()
 
 
+def iter_base_64(chunks: Iterable[str]) -> Iterator[str]:
+    '''Incremental do_base_64, the concatenation of the output is the same as do_base_64 of the whole input'''
+    rest = b''
+    for chunk in chunks:
+        data = rest + chunk.encode("utf-8")
+        aligned = len(data) - len(data) % 3
+        rest = data[aligned:]
+        if aligned:
+            yield base64.b64encode(data[:aligned]).decode()
+    if rest:
+        yield base64.b64encode(rest).decode()
+
+
 def is_valid_uuid(val: str, version: int | None = None) -> bool:
     try:
         uuid.UUID(val, version=version)
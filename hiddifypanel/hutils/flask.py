@@ -5,11 +5,12 @@ from apiflask import abort as apiflask_abort
 from flask_babel import lazy_gettext as _
 from flask import url_for, Markup  # type: ignore
 from urllib.parse import urlparse
+from dataclasses import dataclass, fields
 import user_agents
+import functools
 import re
 import os
 
-from hiddifypanel.cache import cache
 from hiddifypanel.models import *
 from hiddifypanel import hutils
 
@@ -43,64 +44,112 @@ def hurl_for(endpoint, **values):
     return url_for(endpoint, **values)
 
 
-def get_user_agent() -> dict:
-    ua = __parse_user_agent(request.user_agent.string)
+def get_user_agent() -> 'UserAgent':
+    return parse_user_agent(request.user_agent.string)
 
-    if ua.get('v', 1) < 5:
-        __parse_user_agent.invalidate_all()  # type:ignore
-        ua = __parse_user_agent(request.user_agent.string)
-    return ua
 
+@dataclass(frozen=True, slots=True)
+class UserAgent:
+    '''Classification of a user agent, it can also be read like the dict it used to be: ua['is_browser']'''
+    is_bot: bool
+    is_browser: bool
+    os: str
+    os_version: tuple
+    app: str | None
+    is_clash: bool
+    is_clash_meta: bool
+    is_singbox: bool
+    is_hiddify: bool
+    is_streisand: bool
+    is_shadowrocket: bool
+    is_v2ray: bool
+    hiddify_version: tuple
+    singbox_version: tuple
 
-ua_version_pattern = re.compile(r'/(\d+\.\d+(\.\d+)?)')
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def items(self):
+        return ((f.name, getattr(self, f.name)) for f in fields(self))
 
 
-@cache.cache()
-def __parse_user_agent(ua: str) -> dict:
+ua_version_pattern = re.compile(r'/(\d+\.\d+(\.\d+)?)')
+
+# (group name, prefix pattern, flags), longer prefixes first as the first matching alternative wins
+__ua_prefixes = [
+    ('mozilla', 'Mozilla', {'is_browser'}),
+    ('hiddifynext', 'HiddifyNext', {'is_singbox', 'is_hiddify', 'is_v2ray'}),
+    ('hiddifydesktop', 'hiddify-desktop', {'is_clash_meta', 'is_v2ray'}),
+    ('hiddify', 'Hiddify', {'is_v2ray'}),
+    ('clashverge', 'Clash-verge', {'is_clash', 'is_clash_meta'}),
+    ('clashmeta', 'Clash-?Meta', {'is_clash', 'is_clash_meta'}),
+    ('clash', 'Clash', {'is_clash'}),
+    ('stash', 'Stash', {'is_clash', 'is_clash_meta'}),
+    ('nekobox', 'NekoBox', {'is_clash_meta'}),
+    ('nekoray', 'NekoRay', {'is_clash_meta'}),
+    ('pharos', 'Pharos', {'is_clash_meta'}),
+    ('dart', 'Dart', {'is_singbox'}),
+    ('sfi', 'SFI', {'is_singbox'}),
+    ('sfa', 'SFA', {'is_singbox'}),
+    ('streisand', 'Streisand', {'is_streisand'}),
+    ('shadowrocket', 'Shadowrocket', {'is_shadowrocket', 'is_v2ray', 'ios'}),
+    ('foxray', 'FoXray', {'is_v2ray', 'ios'}),
+    ('fair', 'Fair', {'is_v2ray', 'ios'}),
+    ('v2rayng', 'v2rayNG', {'is_v2ray'}),
+    ('sagernet', 'SagerNet', {'is_v2ray'}),
+    ('v2box', 'V2Box', {'is_v2ray', 'ios'}),
+    ('loon', 'Loon', {'is_v2ray', 'ios'}),
+    ('liberty', 'Liberty', {'is_v2ray', 'ios'}),
+]
+__ua_prefix_pattern = re.compile('^(?:' + '|'.join(f'(?P<{name}>{pattern})' for name, pattern, flags in __ua_prefixes) + ')', re.IGNORECASE)
+__ua_prefix_flags = {name: flags for name, pattern, flags in __ua_prefixes}
+__ua_apps = ['Hiddify', 'FoXray', 'Fair', 'v2rayNG', 'SagerNet', 'Shadowrocket', 'V2Box', 'Loon', 'Liberty', 'Clash', 'Meta', 'Stash', 'SFI', 'SFA', 'HiddifyNext']
+
+
+@functools.lru_cache(maxsize=2048)
+def parse_user_agent(ua: str) -> UserAgent:
     # Example: SFA/1.8.0 (239; sing-box 1.8.0)
     # Example: SFA/1.7.0 (239; sing-box 1.7.0)
     # Example: HiddifyNext/0.13.6 (android) like ClashMeta v2ray sing-box
 
-    uaa = user_agents.parse(request.user_agent.string)
-
-    match = re.search(ua_version_pattern, request.user_agent.string)
-    generic_version = list(map(int, match.group(1).split('.'))) if match else [0, 0, 0]
-    res = {}
-    res['v'] = 5
-    res["is_bot"] = uaa.is_bot
-    res["is_browser"] = re.match('^Mozilla', ua, re.IGNORECASE) and True
-    res['os'] = uaa.os.family
-    res['os_version'] = uaa.os.version
-    res['is_clash'] = re.match('^(Clash|Stash)', ua, re.IGNORECASE) and True
-    res['is_clash_meta'] = re.match('^(Clash-verge|Clash-?Meta|Stash|NekoBox|NekoRay|Pharos|hiddify-desktop)', ua, re.IGNORECASE) and True
-    res['is_singbox'] = re.match('^(HiddifyNext|Dart|SFI|SFA)', ua, re.IGNORECASE) and True
-    res['is_hiddify'] = re.match('^(HiddifyNext)', ua, re.IGNORECASE) and True
-    res['is_streisand'] = re.match('^(Streisand)', ua, re.IGNORECASE) and True
-    res['is_shadowrocket'] = re.match('^(Shadowrocket)', ua, re.IGNORECASE) and True
-
-    if res['is_singbox']:
-        res['singbox_version'] = generic_version
-
-    if ['is_hiddify']:
-        res['hiddify_version'] = generic_version
-        if generic_version[0] == 0 and generic_version[1] <= 14:
-            res['singbox_version'] = [1, 7, 0]
-        else:
-            res['singbox_version'] = [1, 8, 0]
-
-    res['is_v2ray'] = re.match('^(Hiddify|FoXray|Fair|v2rayNG|SagerNet|Shadowrocket|V2Box|Loon|Liberty)', ua, re.IGNORECASE) and True
-
-    if res['os'] == 'Other':
-        if re.match('^(FoXray|Fair|Shadowrocket|V2Box|Loon|Liberty)', ua, re.IGNORECASE):
-            res['os'] = 'iOS'
-            # res['os_version']
-
-    for a in ['Hiddify', 'FoXray', 'Fair', 'v2rayNG', 'SagerNet', 'Shadowrocket', 'V2Box', 'Loon', 'Liberty', 'Clash', 'Meta', 'Stash', 'SFI', 'SFA', 'HiddifyNext']:
-        if a.lower() in ua.lower():
-            res['app'] = a
-    if res["is_browser"]:
-        res['app'] = uaa.browser.family
-    return res
+    uaa = user_agents.parse(ua)
+
+    match = ua_version_pattern.search(ua)
+    generic_version = tuple(map(int, match.group(1).split('.'))) if match else (0, 0, 0)
+    prefix = __ua_prefix_pattern.match(ua)
+    flags = __ua_prefix_flags[prefix.lastgroup] if prefix else set()
+
+    os_family = uaa.os.family
+    if os_family == 'Other' and 'ios' in flags:
+        os_family = 'iOS'
+
+    app = None
+    ua_lower = ua.lower()
+    for a in __ua_apps:
+        if a.lower() in ua_lower:
+            app = a
+    if 'is_browser' in flags:
+        app = uaa.browser.family
+
+    return UserAgent(
+        is_bot=uaa.is_bot,
+        is_browser='is_browser' in flags,
+        os=os_family,
+        os_version=uaa.os.version,
+        app=app,
+        is_clash='is_clash' in flags,
+        is_clash_meta='is_clash_meta' in flags,
+        is_singbox='is_singbox' in flags,
+        is_hiddify='is_hiddify' in flags,
+        is_streisand='is_streisand' in flags,
+        is_shadowrocket='is_shadowrocket' in flags,
+        is_v2ray='is_v2ray' in flags,
+        hiddify_version=generic_version,
+        singbox_version=(1, 7, 0) if generic_version[0] == 0 and generic_version[1] <= 14 else (1, 8, 0),
+    )
 
 
 def get_proxy_path_from_url(url: str) -> str | None:
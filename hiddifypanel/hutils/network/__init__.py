@@ -2,3 +2,4 @@
 from . import auto_ip_selector
 # from .ip import get_domain_ip, get_socket_public_ip, get_interface_public_ip, get_ips, get_ip
 from .net import *
+from .dns_cache import resolve_domains, get_cached_domain_ip
@@ -1,8 +1,8 @@
 from flask_babel import gettext as _
 from typing import List, Union
 from flask import request
-import maxminddb
 import random
+import threading
 import os
 import re
 import sys
@@ -36,14 +36,36 @@ dbn.ircf.space		DBN
 apt.ircf.space		APT
 """
 
-try:
-    IPASN = maxminddb.open_database('GeoLite2-ASN.mmdb') if os.path.exists('GeoLite2-ASN.mmdb') else {}
-    IPCOUNTRY = maxminddb.open_database('GeoLite2-Country.mmdb') if os.path.exists('GeoLite2-Country.mmdb') else {}
-    __ipcity = maxminddb.open_database('GeoLite2-City.mmdb') if os.path.exists('GeoLite2-City.mmdb') else {}
-except Exception as e:
-    print("Error can not load maxminddb", file=sys.stderr)
-    IPASN = {}
-    IPCOUNTRY = {}
+
+class MaxmindDatabase:
+    '''Opens the database on the first lookup, so the processes which do not need it start faster'''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.__db = None
+        self.__lock = threading.Lock()
+
+    def __load(self):
+        with self.__lock:
+            if self.__db is None:
+                try:
+                    import maxminddb
+                    self.__db = maxminddb.open_database(self.path) if os.path.exists(self.path) else {}
+                except Exception as e:
+                    print(f"Error can not load maxminddb {self.path}", e, file=sys.stderr)
+                    self.__db = {}
+        return self.__db
+
+    def get(self, ip):
+        return (self.__db if self.__db is not None else self.__load()).get(ip)
+
+    def __bool__(self):
+        return bool(self.__db if self.__db is not None else self.__load())
+
+
+IPASN = MaxmindDatabase('GeoLite2-ASN.mmdb')
+IPCOUNTRY = MaxmindDatabase('GeoLite2-Country.mmdb')
+__ipcity = MaxmindDatabase('GeoLite2-City.mmdb')
 
 __asn_map = {
     '58224': 'MKH',
@@ -177,5 +199,5 @@ def get_clean_ip(ips: Union[str, List[str]], resolve: bool = False, default_asn:
         selected_server = random.sample(ips, 1)[0]
     # print("selected_server",selected_server)
     if resolve:
-        selected_server = hutils.network.get_domain_ip(selected_server) or selected_server
+        selected_server = hutils.network.get_cached_domain_ip(selected_server) or selected_server
     return str(selected_server)
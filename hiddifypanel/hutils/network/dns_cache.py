@@ -0,0 +1,114 @@
+'''
+In-process cache of the domain ips used while serving requests, so the handlers do not wait for dns.
+Missing domains are resolved in parallel with a bounded wait, expired entries are served
+while they are refreshed in background, and a refresher thread keeps the used domains warm.
+'''
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Iterable, Literal
+import ipaddress
+import threading
+import time
+import os
+
+from .net import get_domain_ip
+
+TTL = 300
+NEGATIVE_TTL = 60
+COLD_TIMEOUT = 2  # max seconds a request waits for the domains which are not in the cache
+REFRESH_INTERVAL = 30
+MAX_ENTRIES = 4096
+
+_entries = {}  # (domain, version) -> [ip, resolved_at, last_used]
+_pending = {}  # (domain, version) -> Future
+_lock = threading.Lock()
+_pid = None
+_executor = None
+
+
+def _expire_time(entry) -> float:
+    return entry[1] + (TTL if entry[0] else NEGATIVE_TTL)
+
+
+def _resolve(key):
+    domain, version = key
+    try:
+        ip = get_domain_ip(domain, version=version)
+    except Exception:
+        ip = None
+    with _lock:
+        now = time.monotonic()
+        _pending.pop(key, None)
+        entry = _entries.get(key)
+        _entries[key] = [ip, now, entry[2] if entry else now]
+    return ip
+
+
+def _submit(key):
+    '''Should be called with _lock held'''
+    future = _pending.get(key)
+    if future is None:
+        future = _pending[key] = _get_executor().submit(_resolve, key)
+    return future
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    '''Threads do not survive the fork of the workers, so every process starts its own'''
+    global _pid, _executor
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        _pending.clear()  # the resolved entries are still valid in the forked process
+        _executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="dns-cache")
+        threading.Thread(target=_refresh_loop, name="dns-cache-refresh", daemon=True).start()
+    return _executor
+
+
+# the refresher thread may hold the lock while the process is forked
+os.register_at_fork(before=_lock.acquire, after_in_parent=_lock.release, after_in_child=_lock.release)
+
+
+def _refresh_loop():
+    while True:
+        time.sleep(REFRESH_INTERVAL)
+        now = time.monotonic()
+        with _lock:
+            for key, entry in list(_entries.items()):
+                if _expire_time(entry) > now + REFRESH_INTERVAL:
+                    continue
+                if entry[2] >= entry[1]:  # used since the last resolve
+                    _submit(key)
+                else:
+                    del _entries[key]
+            if len(_entries) > MAX_ENTRIES:
+                for key, _ in sorted(_entries.items(), key=lambda kv: kv[1][2])[:len(_entries) - MAX_ENTRIES]:
+                    del _entries[key]
+
+
+def resolve_domains(domains: Iterable[str], versions: Iterable[Literal[4, 6] | None] = (4, 6), timeout: float = COLD_TIMEOUT) -> dict:
+    '''Returns {(domain, version): ip}, ip is None if it is not resolvable or not resolved in time'''
+    res = {}
+    cold = {}
+    with _lock:
+        now = time.monotonic()
+        for domain in domains:
+            for version in versions:
+                key = (domain, version)
+                if key in res or key in cold:
+                    continue
+                entry = _entries.get(key)
+                if entry:
+                    entry[2] = now
+                    res[key] = entry[0]
+                    if _expire_time(entry) < now:
+                        _submit(key)
+                else:
+                    cold[key] = _submit(key)
+    if cold:
+        wait(cold.values(), timeout=timeout)
+        for key, future in cold.items():
+            res[key] = future.result() if future.done() else None
+    return res
+
+
+def get_cached_domain_ip(domain: str, version: Literal[4, 6] | None = None, timeout: float = COLD_TIMEOUT) -> ipaddress.IPv4Address | ipaddress.IPv6Address | None:
+    '''Cached get_domain_ip, use get_domain_ip when the current dns record is needed (e.g. validation)'''
+    return resolve_domains([domain], [version], timeout)[(domain, version)]
@@ -1,4 +1,3 @@
-import psutil
 import os
 
 
@@ -18,6 +17,7 @@ def get_folder_size(folder_path: str) -> int:
 
 
 def top_processes() -> dict:
+    import psutil
     # Get the process information
     processes = [p for p in psutil.process_iter(['name', 'memory_full_info', 'cpu_percent']) if p.info['name'] != '']
     num_cores = psutil.cpu_count()
@@ -63,6 +63,7 @@ def top_processes() -> dict:
 
 
 def system_stats() -> dict:
+    import psutil
     # CPU usage
     cpu_percent = psutil.cpu_percent(interval=1)
 
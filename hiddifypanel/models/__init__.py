@@ -1,7 +1,7 @@
 from .role import Role, AccountType
 from .child import Child, ChildMode
 from .config_enum import ConfigCategory, ConfigEnum, Lang, ApplyMode
-from .config import StrConfig, BoolConfig, get_hconfigs, hconfig, set_hconfig, add_or_update_config, bulk_register_configs, get_hconfigs_childs
+from .config import StrConfig, BoolConfig, get_hconfigs, hconfig, set_hconfig, set_hconfigs, add_or_update_config, bulk_register_configs, get_hconfigs_childs, get_config_generation, bump_config_generation, invalidate_hconfigs
 
 # from .parent_domain import ParentDomain
 from .domain import Domain, DomainType, ShowDomain, get_domain, get_current_proxy_domains, get_panel_domains, get_proxy_domains, get_proxy_domains_db, get_hdomains, hdomain, add_or_update_domain, bulk_register_domains
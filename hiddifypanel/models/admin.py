@@ -2,7 +2,7 @@ from enum import auto
 import uuid
 from flask import g
 from hiddifypanel.models.usage import DailyUsage
-from hiddifypanel.models.utils import fill_username, fill_password
+from hiddifypanel.models.utils import fill_username, fill_password, request_cached
 from sqlalchemy import event
 from strenum import StrEnum
 from apiflask import abort
@@ -64,7 +64,7 @@ class AdminUser(BaseAccount):
 
     @classmethod
     def by_uuid(cls, uuid: str, create: bool = False) -> BaseAccount | None:
-        account = AdminUser.query.filter(AdminUser.uuid == uuid).first()
+        account = request_cached(('AdminUser', 'uuid', f'{uuid}'), lambda: AdminUser.query.filter(AdminUser.uuid == uuid).first())
         if not account and create:
             dbuser = AdminUser(uuid=uuid, name="unknown", parent_admin_id=AdminUser.current_admin_or_owner().id)
             db.session.add(dbuser)
@@ -156,7 +156,7 @@ class AdminUser(BaseAccount):
     def current_admin_or_owner():
         if g and hasattr(g, 'account') and g.account and isinstance(g.account, AdminUser):
             return g.account
-        return AdminUser.query.filter(AdminUser.id == 1).first()
+        return AdminUser.by_id(1)
 
 
 @event.listens_for(AdminUser, "before_insert")
@@ -6,6 +6,7 @@ from sqlalchemy_serializer import SerializerMixin
 from flask_login import UserMixin as FlaskLoginUserMixin
 from hiddifypanel.models import Lang
 from hiddifypanel.database import db
+from hiddifypanel.models.utils import request_cached
 
 
 class BaseAccount(db.Model, SerializerMixin, FlaskLoginUserMixin):  # type: ignore
@@ -44,11 +45,11 @@ class BaseAccount(db.Model, SerializerMixin, FlaskLoginUserMixin):  # type: igno
     @classmethod
     def by_id(cls, id: int):
         # return cls.query.filter(cls.id == id).first()
-        return cls.query.get(id)
+        return request_cached((cls.__name__, 'id', id), lambda: cls.query.get(id))
 
     @classmethod
     def by_uuid(cls, uuid: str, create: bool = False):
-        account = cls.query.filter(cls.uuid == uuid).first()
+        account = request_cached((cls.__name__, 'uuid', f'{uuid}'), lambda: cls.query.filter(cls.uuid == uuid).first())
         if not account and create:
             raise NotImplementedError
         return account
@@ -7,6 +7,7 @@ from flask import g, has_app_context
 
 
 from hiddifypanel.database import db
+from hiddifypanel.models.utils import request_cached
 
 
 class ChildMode(StrEnum):
@@ -56,7 +57,7 @@ class Child(db.Model, SerializerMixin):
 
     @classmethod
     def by_id(cls, id: int) -> "Child":
-        return Child.query.filter(Child.id == id).first()
+        return request_cached(('Child', 'id', id), lambda: Child.query.filter(Child.id == id).first())
 
     @classmethod
     @property
@@ -1,11 +1,16 @@
+import os
+import threading
+import time
+import redis
 from hiddifypanel.models.config_enum import ConfigEnum
-from flask import g
+from flask import g, has_app_context
 from sqlalchemy_serializer import SerializerMixin
 from hiddifypanel import Events
 from hiddifypanel.database import db
-from hiddifypanel.cache import cache
+from hiddifypanel.cache import redis_client, redis_pubsub_client, redis_breaker
 from hiddifypanel.models.child import Child, ChildMode
-from sqlalchemy import Column, String, Boolean, Enum, ForeignKey, Integer
+from sqlalchemy import Column, String, Boolean, Enum, ForeignKey, Integer, event
+from sqlalchemy.orm import Session, object_session
 
 
 def error(st):
@@ -41,83 +46,219 @@ class StrConfig(db.Model, SerializerMixin):
         }
 
 
-@cache.cache(ttl=500)
+CONFIG_GENERATION_KEY = "h:config-generation"
+CONFIG_CHANGED_CHANNEL = "h:config-changed"
+
+
+def get_config_generation() -> int:
+    '''Counter shared by all workers, increased on every config, domain or proxy change.
+    It is read from redis once per request.'''
+    if has_app_context():
+        if 'config_generation' not in g:
+            g.config_generation = __read_config_generation()
+        return g.config_generation
+    return __read_config_generation()
+
+
+def __read_config_generation() -> int:
+    if redis_breaker.allow():
+        try:
+            generation = int(redis_client.get(CONFIG_GENERATION_KEY) or 0)
+            redis_breaker.success()
+            return generation
+        except redis.RedisError as e:
+            error(f'can not read the config generation: {e}')
+            redis_breaker.failure()
+    # while redis is down the changes of the other workers can not be seen, so the local caches are renewed every minute
+    return -int(time.time() // 60)
+
+
+def bump_config_generation(**kwargs):
+    __snapshots.clear()
+    if not redis_breaker.allow():
+        return
+    try:
+        pipe = redis_client.pipeline()
+        pipe.incr(CONFIG_GENERATION_KEY)
+        pipe.publish(CONFIG_CHANGED_CHANNEL, "")
+        generation = pipe.execute()[0]
+        redis_breaker.success()
+    except redis.RedisError as e:
+        error(f'can not bump the config generation: {e}')
+        redis_breaker.failure()
+        return
+    if has_app_context():
+        g.config_generation = generation
+
+
+Events.domain_changed.subscribe(bump_config_generation)
+# the changes made while redis was down did not reach the other workers
+redis_breaker.on_close.append(bump_config_generation)
+
+
+SNAPSHOT_TTL = 60  # the snapshots are reloaded at least every minute, in case a change is not notified
+__snapshots = {}  # child_id -> (generation, loaded_at, {ConfigEnum: value})
+__listener_pid = None
+
+
+def __drop_snapshots(data):
+    __snapshots.clear()
+
+
+# channel -> callback(data) run in every worker, data is None when the messages may have been missed
+__channel_callbacks = {CONFIG_CHANGED_CHANNEL: __drop_snapshots}
+
+
+def listen_channel(channel: str, callback):
+    '''Should be called on import, before the listener of the worker is started'''
+    __channel_callbacks[channel] = callback
+
+
+def __listen_config_changes():
+    '''Drops the snapshots of this worker whenever another one changes the configs (and runs the other channel callbacks)'''
+    while True:
+        try:
+            pubsub = redis_pubsub_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(*__channel_callbacks)
+            for callback in __channel_callbacks.values():
+                callback(None)  # changes may be missed while we were not subscribed
+            for message in pubsub.listen():
+                if callback := __channel_callbacks.get(message['channel'].decode()):
+                    callback(message['data'])
+        except Exception as e:
+            error(f'config change listener failed: {e}')
+            time.sleep(1)
+
+
+def __start_listener():
+    '''Threads do not survive the fork of the workers, so every process starts its own'''
+    global __listener_pid
+    if __listener_pid != os.getpid():
+        __listener_pid = os.getpid()
+        __snapshots.clear()
+        threading.Thread(target=__listen_config_changes, name="config-changes", daemon=True).start()
+
+
+def __get_snapshot(child_id: int) -> dict:
+    __start_listener()
+    generation = get_config_generation()
+    snapshot = __snapshots.get(child_id)
+    if snapshot is None or snapshot[0] != generation or time.monotonic() - snapshot[1] > SNAPSHOT_TTL:
+        configs = {**{u.key: u.value for u in BoolConfig.query.filter(BoolConfig.child_id == child_id).all() if u.key.type == bool},
+                   **{u.key: u.value for u in StrConfig.query.filter(StrConfig.child_id == child_id).all() if u.key.type != bool},
+                   # ConfigEnum.telegram_fakedomain:hdomain(DomainType.telegram_faketls),
+                   # ConfigEnum.ssfaketls_fakedomain:hdomain(DomainType.ss_faketls),
+                   # ConfigEnum.fake_cdn_domain:hdomain(DomainType.fake_cdn)
+                   }
+        snapshot = __snapshots[child_id] = (generation, time.monotonic(), configs)
+    return snapshot[2]
+
+
+def invalidate_hconfigs():
+    __snapshots.clear()
+
+
+@event.listens_for(Session, 'after_commit')
+def __after_commit(session):
+    if session.info.pop('config_changed', False):
+        bump_config_generation()
+
+
+@event.listens_for(Session, 'after_rollback')
+def __after_rollback(session):
+    if session.info.pop('config_changed', False):
+        __snapshots.clear()
+
+
+def __mark_config_changed(mapper, connection, target):
+    if session := object_session(target):
+        session.info['config_changed'] = True
+
+
+__tracked_models = set()
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def __after_bulk_change(context):
+    '''query.update() and query.delete() do not fire the mapper events'''
+    if getattr(context.mapper, 'class_', None) in __tracked_models:
+        context.session.info['config_changed'] = True
+
+
+def track_config_changes(model):
+    '''Bumps the config generation after the commit of any insert, update or delete of the model'''
+    __tracked_models.add(model)
+    for e in ['after_insert', 'after_update', 'after_delete']:
+        event.listen(model, e, __mark_config_changed)
+
+
+track_config_changes(BoolConfig)
+track_config_changes(StrConfig)
+
+
 def hconfig(key: ConfigEnum, child_id: int | None = None) -> str | int | None:
     if child_id is None:
         child_id = Child.current.id
-
-    value = None
-    try:
-        if key.type == bool:
-            bool_conf = BoolConfig.query.filter(BoolConfig.key == key, BoolConfig.child_id == child_id).first()
-            if bool_conf:
-                value = bool_conf.value
-            else:
-                error(f'bool {key} not found ')
-        else:
-            str_conf = StrConfig.query.filter(StrConfig.key == key, StrConfig.child_id == child_id).first()
-            if str_conf:
-                value = str_conf.value
-            else:
-                error(f'str {key} not found ')
-    except BaseException:
-        error(f'{key} error!')
-        raise
-
-    return value
+    return __get_snapshot(child_id).get(key)
 
 
 def set_hconfig(key: ConfigEnum, value: str | int | bool, child_id: int = None, commit: bool = True):
+    set_hconfigs({key: value}, child_id, commit=commit)
+
+
+def set_hconfigs(configs: dict[ConfigEnum, str | int | bool], child_id: int | None = None, commit: bool = True):
+    '''Upserts the configs with one query per config table and notifies config_changed once with all the changes'''
     if child_id is None:
         child_id = Child.current.id
-    print(f"chainging .... {key}---{value}---{child_id}---{commit}")
-    # hconfig.invalidate(key, child_id)
-    # get_hconfigs.invalidate(child_id)
-    hconfig.invalidate(key, child_id)
-    hconfig.invalidate(key, child_id=child_id)
-    hconfig.invalidate(key=key, child_id=child_id)
-    if child_id == Child.current.id:
-        hconfig.invalidate(key)
-    # hconfig.invalidate_all()
-    get_hconfigs.invalidate_all()
-    old_v = None
-    if key.type == bool:
-        dbconf = BoolConfig.query.filter(BoolConfig.key == key, BoolConfig.child_id == child_id).first()
-        if not dbconf:
-            dbconf = BoolConfig(key=key, value=value, child_id=child_id)
-            db.session.add(dbconf)
-        else:
-            old_v = dbconf.value
-    else:
-        dbconf = StrConfig.query.filter(StrConfig.key == key, StrConfig.child_id == child_id).first()
-        if not dbconf:
-            dbconf = StrConfig(key=key, value=value, child_id=child_id)
-            db.session.add(dbconf)
-        else:
-            old_v = dbconf.value
-    dbconf.value = value
-    error(f"changing {key} from {old_v} to {value}")
-    Events.config_changed.notify(conf=dbconf, old_value=old_v)
-
-    if child_id == 0 and key.hide_in_virtual_child:
-        for child in Child.query.filter(Child.mode == ChildMode.virtual, Child.id != 0).all():
-            set_hconfig(key, value, child.id)
+    print(f"chainging .... {configs}---{child_id}---{commit}")
+    child_configs = {child_id: configs}
+    if child_id == 0:
+        virtual_configs = {k: v for k, v in configs.items() if k.hide_in_virtual_child}
+        if virtual_configs:
+            for child in Child.query.filter(Child.mode == ChildMode.virtual, Child.id != 0).all():
+                child_configs[child.id] = virtual_configs
+
+    changes = []
+    for model, is_bool in [(BoolConfig, True), (StrConfig, False)]:
+        keys = {k for confs in child_configs.values() for k in confs if (k.type == bool) == is_bool}
+        if not keys:
+            continue
+        dbconfs = {(c.child_id, c.key): c for c in model.query.filter(model.child_id.in_(child_configs.keys()), model.key.in_(keys)).all()}
+        for cid, confs in child_configs.items():
+            for key, value in confs.items():
+                if (key.type == bool) != is_bool:
+                    continue
+                old_v = None
+                dbconf = dbconfs.get((cid, key))
+                if not dbconf:
+                    dbconf = model(key=key, value=value, child_id=cid)
+                    db.session.add(dbconf)
+                elif dbconf.value == value:
+                    continue
+                else:
+                    old_v = dbconf.value
+                dbconf.value = value
+                error(f"changing {key} from {old_v} to {value}")
+                changes.append((dbconf, old_v))
+
+    if changes:
+        # the other workers reload their snapshots after the commit
+        __snapshots.clear()
+        db.session.info['config_changed'] = True
+        Events.config_changed.notify(changes=changes)
 
     if commit:
         db.session.commit()
 
 
-@cache.cache(ttl=500,)
 def get_hconfigs(child_id: int | None = None, json=False):
     if child_id is None:
         child_id = Child.current.id
-
-    return {**{f'{u.key}' if json else u.key: u.value for u in BoolConfig.query.filter(BoolConfig.child_id == child_id).all() if u.key.type == bool},
-            **{f'{u.key}' if json else u.key: u.value for u in StrConfig.query.filter(StrConfig.child_id == child_id).all() if u.key.type != bool},
-            # ConfigEnum.telegram_fakedomain:hdomain(DomainType.telegram_faketls),
-            # ConfigEnum.ssfaketls_fakedomain:hdomain(DomainType.ss_faketls),
-            # ConfigEnum.fake_cdn_domain:hdomain(DomainType.fake_cdn)
-            }
+    configs = __get_snapshot(child_id)
+    if json:
+        return {f'{k}': v for k, v in configs.items()}
+    return dict(configs)
 
 
 def get_hconfigs_childs(child_ids: list[int], json=False):
@@ -126,28 +267,26 @@ def get_hconfigs_childs(child_ids: list[int], json=False):
     return {c: get_hconfigs(c, json) for c in child_ids}
 
 
-def add_or_update_config(commit: bool = True, child_id: int = None, override_unique_id: bool = True, **config):
-    if child_id is None:
-        child_id = Child.current.id
+def __parse_config(config: dict, override_unique_id: bool = True) -> tuple[ConfigEnum, str | bool] | None:
     c = config['key']
     ckey = ConfigEnum(c)
     if c == ConfigEnum.unique_id and not override_unique_id:
-        return
-
-    v = str(config['value']).lower() == "true" if ckey.type == bool else config['value']
+        return None
     if ckey in [ConfigEnum.db_version]:
-        return
-    set_hconfig(ckey, v, child_id, commit=commit)
+        return None
+    v = str(config['value']).lower() == "true" if ckey.type == bool else config['value']
+    return ckey, v
+
+
+def add_or_update_config(commit: bool = True, child_id: int = None, override_unique_id: bool = True, **config):
+    if child_id is None:
+        child_id = Child.current.id
+    if parsed := __parse_config(config, override_unique_id):
+        set_hconfig(*parsed, child_id, commit=commit)
 
 
 def bulk_register_configs(hconfigs, commit: bool = True, override_child_unique_id: int | None = None, override_unique_id: bool = True):
     from hiddifypanel.panel import hiddify
-    for conf in hconfigs:
-        # print(conf)
-        if conf['key'] == ConfigEnum.unique_id and not override_unique_id:
-            continue
-        child_id = hiddify.get_child(unique_id=None)
-        # print(conf, child_id, conf.get('child_unique_id', None), override_child_unique_id)
-        add_or_update_config(commit=False, child_id=child_id, **conf)
-    if commit:
-        db.session.commit()
+    child_id = hiddify.get_child(unique_id=None)
+    configs = dict(parsed for conf in hconfigs if (parsed := __parse_config(conf, override_unique_id)))
+    set_hconfigs(configs, child_id, commit=commit)
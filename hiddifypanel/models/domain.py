@@ -12,7 +12,7 @@ from strenum import StrEnum
 
 from hiddifypanel.database import db
 
-from hiddifypanel.models.config import hconfig
+from hiddifypanel.models.config import hconfig, track_config_changes
 from .child import Child
 from hiddifypanel.models.config_enum import ConfigEnum
 from sqlalchemy.orm import backref
@@ -115,6 +115,9 @@ class Domain(db.Model, SerializerMixin):
         return int(hconfig(ConfigEnum.reality_port, self.child_id)) + self.port_index
 
 
+track_config_changes(Domain)
+
+
 def hdomains(mode):
     domains = Domain.query.filter(Domain.mode == mode).all()
     if domains:
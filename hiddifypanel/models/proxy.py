@@ -4,6 +4,7 @@ from sqlalchemy_serializer import SerializerMixin
 from strenum import StrEnum
 
 from hiddifypanel.database import db
+from hiddifypanel.models.config import track_config_changes
 
 
 class ProxyTransport(StrEnum):
@@ -109,3 +110,6 @@ class Proxy(db.Model, SerializerMixin):
 
     def __str__(self):
         return str(self.to_dict())
+
+
+track_config_changes(Proxy)
@@ -8,7 +8,7 @@ from sqlalchemy import event
 
 from hiddifypanel.database import db
 from hiddifypanel.models import Lang
-from hiddifypanel.models.utils import fill_password, fill_username
+from hiddifypanel.models.utils import fill_password, fill_username, request_cached
 from hiddifypanel.models.base_account import BaseAccount
 from hiddifypanel.models.admin import AdminUser
 
@@ -190,7 +190,7 @@ class User(BaseAccount):
 
     @classmethod
     def by_uuid(cls, uuid: str, create: bool = False) -> 'User':
-        account = User.query.filter(User.uuid == uuid).first()
+        account = request_cached(('User', 'uuid', f'{uuid}'), lambda: User.query.filter(User.uuid == uuid).first())
         if not account and create:
             dbuser = User(uuid=uuid, name="unknown", added_by=AdminUser.current_admin_or_owner().id)
             db.session.add(dbuser)
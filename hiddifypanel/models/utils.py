@@ -1,3 +1,7 @@
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from hiddifypanel.database import db
 
 
 def fill_username(model) -> None:
@@ -24,3 +28,38 @@ def fill_password(model) -> None:
     # TODO: hash the password
     if not model.password or len(model.password) < 16:
         model.password = hutils.random.get_random_password(length=16)
+
+
+def request_cached(key: tuple, loader):
+    '''Memoizes an entity lookup on flask.g, so each entity is fetched at most once per request.
+    Missing entities are not memoized, they may be created later in the request.'''
+    if not has_app_context():
+        return loader()
+    identity_map = g.setdefault('identity_map', {})
+    obj = identity_map.get(key)
+    if obj is not None and obj in db.session:  # the session may be removed in a long app context (e.g. cli)
+        g.identity_map_saved = g.get('identity_map_saved', 0) + 1
+        return obj
+    obj = loader()
+    if obj is not None:
+        identity_map[key] = obj
+    return obj
+
+
+def clear_request_cache():
+    if has_app_context():
+        g.pop('identity_map', None)
+
+
+@event.listens_for(Session, 'after_flush')
+def __after_flush(session, flush_context):
+    if not has_app_context() or not g.get('identity_map'):
+        return
+    # a memoized entity is deleted or may have a new uuid
+    if session.deleted or any(obj in session.dirty for obj in g.identity_map.values()):
+        clear_request_cache()
+
+
+@event.listens_for(Session, 'after_bulk_delete')
+def __after_bulk_delete(delete_context):
+    clear_request_cache()
@@ -12,7 +12,7 @@ from wtforms.validators import Regexp, ValidationError
 from hiddifypanel.models import *
 from hiddifypanel.panel import hiddify, cf_api, custom_widgets
 from .adminlte import AdminLTEModelView
-from hiddifypanel import hutils
+from hiddifypanel import Events, hutils
 
 from flask import current_app
 # Define a custom field type for the related domains
@@ -107,7 +107,7 @@ class DomainAdmin(AdminLTEModelView):
             f'</a><a href="{admin_link}" class="btn btn-xs btn-info ltr" target="_blank">{model.domain}</a></div>')
 
     def _domain_ip(view, context, model, name):
-        dip = hutils.network.get_domain_ip(model.domain)
+        dip = hutils.network.get_cached_domain_ip(model.domain)
         myip = hutils.network.get_ip(4)
         if myip == dip and model.mode == DomainType.direct:
             badge_type = ''
@@ -281,13 +281,14 @@ class DomainAdmin(AdminLTEModelView):
     def after_model_delete(self, model):
         # if hconfig(ConfigEnum.parent_panel):
         #     hiddify_api.sync_child_to_parent()
-        pass
+        Events.domain_changed.notify(domain=model)
 
     def after_model_change(self, form, model, is_created):
         if hconfig(ConfigEnum.first_setup):
             set_hconfig(ConfigEnum.first_setup, False)
         # if hconfig(ConfigEnum.parent_panel):
         #     hiddify_api.sync_child_to_parent()
+        Events.domain_changed.notify(domain=model)
         if model.need_valid_ssl:
             # hiddify.exec_command(f"sudo /opt/hiddify-manager/acme.sh/get_cert.sh {model.domain}")
             # run get_cert.sh
@@ -310,3 +311,9 @@ class DomainAdmin(AdminLTEModelView):
     def get_query(self):
         query = super().get_query()
         return query.filter(Domain.child_id == Child.current.id)
+
+    def get_list(self, *args, **kwargs):
+        count, data = super().get_list(*args, **kwargs)
+        # resolve the domain_ip column of all rows in parallel
+        hutils.network.resolve_domains([d.domain for d in data], [None])
+        return count, data
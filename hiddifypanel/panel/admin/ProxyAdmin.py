@@ -35,7 +35,6 @@ class ProxyAdmin(FlaskView):
 
             db.session.commit()
             # print(cat,vs)
-            hiddify.get_available_proxies.invalidate_all()
             hiddify.check_need_reset(old_configs)
             all_proxy_form = get_all_proxy_form(True)
 
@@ -55,7 +54,6 @@ class ProxyAdmin(FlaskView):
 
                 # print(cat,vs)
             db.session.commit()
-            hiddify.get_available_proxies.invalidate_all()
             hutils.flask.flash_config_success(restart_mode=ApplyMode.apply, domain_changed=False)
             # if hconfig(ConfigEnum.parent_panel):
             #     hiddify_api.sync_child_to_parent()
@@ -73,10 +73,7 @@ class SettingAdmin(FlaskView):
                 hutils.flask.flash(_("ProxyPath is already used! use different proxy path"), 'error')  # type: ignore
                 return render_template('config.html', form=form)
 
-            for k, v in changed_configs.items():
-                set_hconfig(k, v, commit=False)
-
-            db.session.commit()
+            set_hconfigs(changed_configs)
             flask_babel.refresh()
 
             from hiddifypanel.panel.commercial.telegrambot import register_bot
@@ -18,7 +18,7 @@ from hiddifypanel.models import *
 from hiddifypanel.drivers import user_driver
 from hiddifypanel.panel import hiddify, custom_widgets
 from hiddifypanel.auth import login_required
-from hiddifypanel import hutils
+from hiddifypanel import Events, hutils
 
 
 class UserAdmin(AdminLTEModelView):
@@ -271,6 +271,7 @@ class UserAdmin(AdminLTEModelView):
                                   active=g.account.max_active_users, total=g.account.max_users))
         if old_user and old_user.uuid != model.uuid:
             user_driver.remove_client(old_user)
+            Events.user_changed.notify(user=old_user)
         if not model.ed25519_private_key:
             priv, publ = hiddify.get_ed25519_private_public_pair()
             model.ed25519_private_key = priv
@@ -293,10 +294,12 @@ class UserAdmin(AdminLTEModelView):
             user_driver.add_client(model)
         else:
             user_driver.remove_client(model)
+        Events.user_changed.notify(user=model)
         hiddify.quick_apply_users()
 
     def after_model_delete(self, model):
         user_driver.remove_client(model)
+        Events.user_changed.notify(user=model)
         hiddify.quick_apply_users()
 
     def get_list(self, page, sort_column, sort_desc, search, filters, page_size=50, *args, **kwargs):
@@ -1,4 +1,7 @@
 import datetime
+import multiprocessing
+import os
+import time
 import uuid
 
 import click
@@ -9,7 +12,7 @@ from hiddifypanel.models import *
 from hiddifypanel.panel import hiddify, usage
 from hiddifypanel.database import db
 from hiddifypanel.panel.init_db import init_db
-from flask import g
+from flask import g, current_app
 
 
 def drop_db():
@@ -111,6 +114,88 @@ def admin_path():
     print(hiddify.get_account_panel_link(admin, domain, prefere_path_only=True))
 
 
+# url path of the subscription -> user agent used to generate it
+SUBSCRIPTION_EXPORTS = {
+    '/all.txt': 'v2rayNG/1.8.12',
+    '/sub64': 'v2rayNG/1.8.12',
+    '/full-singbox.json': 'HiddifyNext/1.0.0',
+    '/clash/meta/all.yml': 'ClashMeta/1.16.0',
+    '/clash/normal/all.yml': 'Clash/1.18.0',
+}
+# set before the fork of the workers, see export_all_subscriptions
+__exporter = {}
+
+
+def export_all_subscriptions(output, domain=None, workers=None):
+    '''
+    Writes the subscriptions of all active users as <output>/<proxy_path>/<uuid>/<path>, the same
+    path of the panel url, so the directory can be served by a static origin. Headers like the
+    Subscription-Userinfo are not exported.
+    '''
+    users = [u.uuid for u in User.query.all() if u.is_active]
+    if not users:
+        print("No active user")
+        return
+    # a wildcard domain would be exported with one random label for all users
+    domain = domain or next((d.domain for d in get_panel_domains() if '*' not in d.domain), None)
+    if not domain:
+        print("Error: there is no panel domain without a wildcard, use --domain")
+        raise SystemExit(1)
+    __exporter.update({
+        'app': current_app._get_current_object(),
+        'host': domain,
+        'proxy_path': hconfig(ConfigEnum.proxy_path_client),
+        'output': output,
+    })
+    workers = workers or os.cpu_count()
+    start = time.monotonic()
+    # the first user compiles the proxy plan and the singbox base config in this process,
+    # the forked workers inherit them instead of building them again
+    sizes = [export_user_subscriptions(users[0])]
+    db.session.remove()
+    db.engine.dispose()
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        sizes += pool.map(export_user_subscriptions, users[1:], chunksize=max(1, len(users) // (workers * 4)))
+
+    elapsed = time.monotonic() - start
+    print(f"Exported {len(users)} users ({len(users) * len(SUBSCRIPTION_EXPORTS)} subscriptions, {sum(sizes) / 1024 / 1024:.1f}MB) "
+          f"in {elapsed:.1f}s: {len(users) / elapsed:.1f} users/s with {workers} workers into {output}")
+
+
+def export_user_subscriptions(user_uuid) -> int:
+    app = __exporter['app']
+    size = 0
+    # a fresh app context per user, so g (e.g. the identity map) is not shared between the users
+    with app.app_context():
+        g.exporting_subscriptions = True  # the exported bodies are not saved in the rendered subscriptions cache
+        for path, ua in SUBSCRIPTION_EXPORTS.items():
+            url = f"/{__exporter['proxy_path']}/{user_uuid}{path}"
+            body = export_subscription(app, url, ua)
+            if body is None:
+                continue
+            file = os.path.join(__exporter['output'], url.lstrip('/'))
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            with open(file, 'wb') as f:
+                f.write(body)
+            size += len(body)
+    return size
+
+
+def export_subscription(app, url, ua) -> bytes | None:
+    # not using the test client, it would run the before_first_request hooks (telegram bot)
+    with app.test_request_context(url, base_url=f"https://{__exporter['host']}", headers={'User-Agent': ua}):
+        try:
+            resp = app.make_response(app.preprocess_request() or app.dispatch_request())
+            body = resp.get_data()
+        except Exception as e:
+            print(f"Error in exporting {url}: {e}")
+            return None
+    if resp.status_code != 200:
+        print(f"Error in exporting {url}: status {resp.status_code}")
+        return None
+    return body
+
+
 def get_this_host_domains():
     current_child_ids
 
@@ -139,6 +224,13 @@ def init_app(app):
     for command in [hysteria_domain_port, tuic_domain_port, init_db, drop_db, all_configs, update_usage, test, admin_links, admin_path, backup, downgrade]:
         app.cli.add_command(app.cli.command()(command))
 
+    @ app.cli.command()
+    @ click.option("--output", "-o", default="subscriptions", help="Output directory")
+    @ click.option("--domain", "-d", help="Domain used in the subscriptions, default is the first panel domain without a wildcard")
+    @ click.option("--workers", "-w", type=int, help="Number of processes, default is the number of cpus")
+    def export_subscriptions(output, domain, workers):
+        export_all_subscriptions(output, domain, workers)
+
     @ app.cli.command()
     @ click.option("--domain", "-d")
     def add_domain(domain):
@@ -30,7 +30,8 @@ class ProxyDetailsAdmin(AdminLTEModelView):
 
         self.session.commit()
         flash(_('%(count)s records were successfully disabled.', count=count), 'success')
-        hiddify.get_available_proxies.invalidate_all()
+        # bulk updates do not trigger the orm events
+        bump_config_generation()
 
     @action('enable', 'Enable', 'Are you sure you want to enable selected proxies?')
     def action_enable(self, ids):
@@ -39,7 +40,8 @@ class ProxyDetailsAdmin(AdminLTEModelView):
 
         self.session.commit()
         flash(_('%(count)s records were successfully enabled.', count=count), 'success')
-        hiddify.get_available_proxies.invalidate_all()
+        # bulk updates do not trigger the orm events
+        bump_config_generation()
 
     # list_template = 'model/domain_list.html'
 
@@ -48,13 +50,11 @@ class ProxyDetailsAdmin(AdminLTEModelView):
     def after_model_change(self, form, model, is_created):
         # if hconfig(ConfigEnum.parent_panel):
         #     hiddify_api.sync_child_to_parent()
-        hiddify.get_available_proxies.invalidate_all()
         pass
 
     def after_model_delete(self, model):
         # if hconfig(ConfigEnum.parent_panel):
         #     hiddify_api.sync_child_to_parent()
-        hiddify.get_available_proxies.invalidate_all()
         pass
 
     def is_accessible(self):
@@ -24,8 +24,10 @@ def is_valid():
     return True
 
 
-def config_changed_event(conf, old_value):
-    if conf.key == ConfigEnum.is_parent:
+def config_changed_event(changes, **kwargs):
+    for conf, old_value in changes:
+        if conf.key != ConfigEnum.is_parent:
+            continue
         if conf.value and not is_valid():
             set_hconfig(ConfigEnum.is_parent, False)
         if not old_value and conf.value:
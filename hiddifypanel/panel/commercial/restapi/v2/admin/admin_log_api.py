@@ -5,7 +5,6 @@ from hiddifypanel.models.role import Role
 from hiddifypanel.panel import hiddify
 from flask import current_app as app, make_response, g, request
 import os
-from ansi2html import Ansi2HTMLConverter
 from hiddifypanel.auth import login_required
 from hiddifypanel.models import *
 
@@ -32,6 +31,7 @@ class AdminLogApi(MethodView):
             lines = [line for line in f]
             logs = "".join(lines)
 
+        from ansi2html import Ansi2HTMLConverter
         conv = Ansi2HTMLConverter()
         html_log = f'<div style="background-color:black; color:white;padding:10px">{conv.convert(logs)}</div>'
         resp = make_response(html_log)
@@ -0,0 +1,31 @@
+from flask import request, Response
+from flask import current_app as app
+from flask.views import MethodView
+from apiflask.fields import Dict
+from apiflask import Schema
+from hiddifypanel.auth import login_required
+from hiddifypanel.models import Role
+from hiddifypanel.cache import get_cache_stats, get_cache_stats_prometheus, reset_cache_stats
+from . import SuccessfulSchema
+
+
+class CacheStatsSchema(Schema):
+    stats = Dict(required=True, description="Hits, misses, exceptions, redis latency and payload size of each cached function")
+
+
+class AdminCacheStatsApi(MethodView):
+    decorators = [login_required({Role.super_admin})]
+
+    @app.output(CacheStatsSchema)  # type: ignore
+    def get(self):
+        '''Use ?format=prometheus for the prometheus text format'''
+        if request.args.get('format') == 'prometheus':
+            return Response(get_cache_stats_prometheus(), mimetype='text/plain; version=0.0.4')
+        dto = CacheStatsSchema()
+        dto.stats = get_cache_stats()  # type: ignore
+        return dto
+
+    @app.output(SuccessfulSchema)  # type: ignore
+    def delete(self):
+        reset_cache_stats()
+        return {'status': 200, 'msg': 'ok'}
@@ -2,6 +2,7 @@ from flask import g
 from flask.views import MethodView
 from flask import current_app as app
 from apiflask import abort, Schema
+from hiddifypanel import Events
 from hiddifypanel.auth import login_required
 from hiddifypanel.models import *
 from hiddifypanel.panel import hiddify
@@ -101,6 +102,7 @@ class UserApi(MethodView):
         User.add_or_update(**data)  # type: ignore
         user = User.by_uuid(uuid) or abort(502, "unknown issue! user is not added")
         user_driver.add_client(user)
+        Events.user_changed.notify(user=user)
         hiddify.quick_apply_users()
         return {'status': 200, 'msg': 'ok'}
 
@@ -110,5 +112,6 @@ class UserApi(MethodView):
         if not has_permission(user):
             abort(403, "You don't have permission to access this user")
         user.remove()
+        Events.user_changed.notify(user=user)
         hiddify.quick_apply_users()
         return {'status': 200, 'msg': 'ok'}
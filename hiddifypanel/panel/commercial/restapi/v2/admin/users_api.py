@@ -1,6 +1,7 @@
 from flask.views import MethodView
 from flask import current_app as app, g
 from apiflask import abort
+from hiddifypanel import Events
 from hiddifypanel.auth import login_required
 from hiddifypanel.models.role import Role
 from hiddifypanel.panel import hiddify
@@ -35,5 +36,6 @@ class UsersApi(MethodView):
 
         dbuser = User.by_uuid(data['uuid']) or abort(502, "Unknown issue: User is not added")
         user_driver.add_client(dbuser)
+        Events.user_changed.notify(user=dbuser)
         hiddify.quick_apply_users()
         return dbuser.to_dict(False)  # type: ignore
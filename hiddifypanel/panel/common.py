@@ -30,6 +30,12 @@ def init_app(app: APIFlask):
             response.headers['WWW-Authenticate'] = 'Basic realm="Hiddify"'
         return response
 
+    @app.after_request
+    def log_identity_map(response):
+        if app.debug and g.get('identity_map_saved'):
+            print(f"{request.path}: {g.identity_map_saved} lookups served from the request identity map")
+        return response
+
     @app.errorhandler(Exception)
     def internal_server_error(e):
         if hasattr(e, 'code') and e.code == 404:
@@ -12,11 +12,12 @@ from flask_babel import lazy_gettext as _
 from flask_babel import gettext as __
 from datetime import timedelta
 
-from hiddifypanel.cache import cache
+from hiddifypanel.cache import cache, LocalCache
+from sqlalchemy import func, case, and_
 from hiddifypanel.models import *
 from hiddifypanel.database import db
 from hiddifypanel.hutils.utils import *
-from hiddifypanel.Events import domain_changed
+from hiddifypanel.Events import domain_changed, user_changed
 from hiddifypanel import hutils
 from hiddifypanel.panel.run_commander import commander, Command
 import subprocess
@@ -68,9 +69,22 @@ def exec_command(cmd, cwd=None):
         print(e)
 
 
-@cache.cache(ttl=300)
+available_proxies = LocalCache(maxsize=64)
+
+
 def get_available_proxies(child_id):
-    proxies = Proxy.query.filter(Proxy.child_id == child_id).all()
+    '''Cached per config generation, which is increased on every config, domain or proxy change'''
+    key = (child_id, get_config_generation())
+    proxies = available_proxies.get(key)
+    if proxies is None:
+        proxies = __get_available_proxies(child_id)
+        available_proxies.set(key, proxies)
+    return proxies
+
+
+def __get_available_proxies(child_id):
+    # rows of values instead of the Proxy objects, they are shared by the requests and threads of the worker
+    proxies = db.session.query(Proxy.id, Proxy.child_id, Proxy.name, Proxy.enable, Proxy.proto, Proxy.l3, Proxy.transport, Proxy.cdn).filter(Proxy.child_id == child_id).all()
     proxies = [c for c in proxies if 'restls' not in c.transport]
     # if not hconfig(ConfigEnum.tuic_enable, child_id):
     #     proxies = [c for c in proxies if c.proto != ProxyProto.tuic]
@@ -102,13 +116,16 @@ def get_available_proxies(child_id):
     if not hconfig(ConfigEnum.http_proxy_enable, child_id):
         proxies = [c for c in proxies if 'http' != c.l3]
 
-    if not Domain.query.filter(Domain.mode.in_([DomainType.cdn, DomainType.auto_cdn_ip])).first():
+    # mode -> has a cdn domain with a different servername
+    domain_modes = dict(db.session.query(Domain.mode, func.max(case((and_(Domain.servernames != "", Domain.servernames != Domain.domain), 1), else_=0))).group_by(Domain.mode).all())
+    cdn_modes = [DomainType.cdn, DomainType.auto_cdn_ip]
+    if not any(m in domain_modes for m in cdn_modes):
         proxies = [c for c in proxies if c.cdn != "CDN"]
 
-    if not Domain.query.filter(Domain.mode.in_([DomainType.relay])).first():
+    if DomainType.relay not in domain_modes:
         proxies = [c for c in proxies if c.cdn != ProxyCDN.relay]
 
-    if not Domain.query.filter(Domain.mode.in_([DomainType.cdn, DomainType.auto_cdn_ip]), Domain.servernames != "", Domain.servernames != Domain.domain).first():
+    if not any(domain_modes.get(m) for m in cdn_modes):
         proxies = [c for c in proxies if 'Fake' not in c.cdn]
     proxies = [c for c in proxies if not ('vless' == c.proto and ProxyTransport.tcp == c.transport and c.cdn == ProxyCDN.direct)]
     return proxies
@@ -309,6 +326,10 @@ def set_db_from_json(json_data, override_child_unique_id=True, set_users=True, s
     #         u.added_by = g.account.id
 
     db.session.commit()
+    if set_users and 'users' in json_data:
+        user_changed.notify(user=None)
+    if (set_domains and 'domains' in json_data) or (set_settings and 'proxies' in json_data):
+        domain_changed.notify(domain=None)
 
 
 def get_domain_btn_link(domain):
@@ -10,7 +10,7 @@ from dateutil import relativedelta
 
 from hiddifypanel import Events, hutils
 from hiddifypanel.models import *
-from hiddifypanel.models import ConfigEnum, User, set_hconfig, ChildMode
+from hiddifypanel.models import ConfigEnum, User, set_hconfig, ChildMode, bump_config_generation
 from hiddifypanel.panel import hiddify
 from hiddifypanel.database import db
 import hiddifypanel.models.utils as model_utils
@@ -610,8 +610,7 @@ def upgrade_database():
 
 def init_db():
     db.create_all()
-    hconfig.invalidate_all()
-    get_hconfigs.invalidate_all()
+    bump_config_generation()  # also drops the snapshots of the other workers
     # set_hconfig(ConfigEnum.db_version, 71)
     # temporary fix
     add_column(Child.mode)
@@ -655,6 +654,7 @@ def init_db():
             set_hconfig(ConfigEnum.db_version, db_version, child_id=child.id, commit=False)
 
         db.session.commit()
+    bump_config_generation()  # the raw sql of the migrations is not tracked
     g.child = Child.by_id(0)
     return BoolConfig.query.all()
 
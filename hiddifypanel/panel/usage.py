@@ -11,8 +11,11 @@ to_gig_d = 1024**3
 
 
 def update_local_usage():
-    res = user_driver.get_users_usage(reset=True)
-    return add_users_usage(res, child_id=0)
+    deadline = user_driver.new_deadline()
+    res = user_driver.get_users_usage(reset=True, deadline=deadline)
+    res = add_users_usage(res, child_id=0, deadline=deadline)
+    res['drivers'] = user_driver.get_driver_stats()
+    return res
 
     # return {"status": 'success', "comments":res}
 
@@ -23,15 +26,17 @@ def add_users_usage_uuid(uuids_bytes, child_id):
     add_users_usage(dbusers_bytes, child_id)
 
 
-def add_users_usage(dbusers_bytes, child_id):
+def add_users_usage(dbusers_bytes, child_id, deadline=None):
     print(dbusers_bytes)
     if not hconfig(ConfigEnum.is_parent) and hconfig(ConfigEnum.parent_panel):
         from hiddifypanel.panel import hiddify_api
         hiddify_api.add_user_usage_to_parent(dbusers_bytes)
 
     res = {}
-    have_change = False
-    before_enabled_users = user_driver.get_enabled_users()
+    added_users = []
+    removed_users = []
+    deadline = deadline or user_driver.new_deadline()
+    before_enabled_users = user_driver.get_enabled_users(deadline=deadline)
     daily_usage = {}
     today = datetime.date.today()
     for adm in AdminUser.query.all():
@@ -60,9 +65,7 @@ def add_users_usage(dbusers_bytes, child_id):
 
         if not before_enabled_users[user.uuid] and user.is_active:
             print(f"Enabling disabled client {user.uuid} ")
-            user_driver.add_client(user)
-            send_bot_message(user)
-            have_change = True
+            added_users.append(user)
         if not isinstance(usage_bytes, int) or usage_bytes == 0:
             res[user.uuid] = "No usage"
         else:
@@ -79,14 +82,22 @@ def add_users_usage(dbusers_bytes, child_id):
 
         if before_enabled_users[user.uuid] and not user.is_active:
             print(f"Removing enabled client {user.uuid} ")
-            user_driver.remove_client(user)
-            have_change = True
+            removed_users.append(user)
             res[user.uuid] = f"{res[user.uuid]} !OUT of USAGE! Client Removed"
 
+    failed_drivers = {
+        'add_clients': user_driver.add_clients(added_users, deadline=deadline),
+        'remove_clients': user_driver.remove_clients(removed_users, deadline=deadline),
+    }
+    for user in added_users:
+        send_bot_message(user)
     db.session.commit()
-    if have_change:
+    if added_users or removed_users:
         hiddify.quick_apply_users()
 
+    failed_drivers = {method: names for method, names in failed_drivers.items() if names}
+    if failed_drivers:
+        return {"status": 'error', "comments": res, "failed_drivers": failed_drivers}
     return {"status": 'success', "comments": res}
 
 
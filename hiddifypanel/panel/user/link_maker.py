@@ -5,6 +5,7 @@ from hiddifypanel.models import *
 import yaml
 import json
 from hiddifypanel.panel import hiddify
+from hiddifypanel.cache import LocalCache
 import random
 import re
 import datetime
@@ -112,8 +113,16 @@ def get_port(proxy, hconfigs, domain_db, ptls, phttp, pport):
 
 
 def make_proxy(hconfigs, proxy: Proxy, domain_db: Domain, phttp=80, ptls=443, pport=None) -> dict:
+    base = make_proxy_skeleton(hconfigs, proxy, domain_db, phttp, ptls, pport)
+    if 'msg' in base:
+        return base
+    return add_user_info(base, g.account, hconfigs)
+
+
+def make_proxy_skeleton(hconfigs, proxy: Proxy, domain_db: Domain, phttp=80, ptls=443, pport=None) -> dict:
+    '''Same as make_proxy but without the user dependent fields (see add_user_info)'''
     l3 = proxy.l3
-    domain = domain_db.domain
+    domain = get_domain_pattern(domain_db)
     child_id = domain_db.child_id
     name = proxy.name
     port = get_port(proxy, hconfigs, domain_db, ptls, phttp, pport)
@@ -128,7 +137,7 @@ def make_proxy(hconfigs, proxy: Proxy, domain_db: Domain, phttp=80, ptls=443, pp
         alpn = "h2" if proxy.transport in ['h2', "grpc"] else 'http/1.1'
     else:
         alpn = "h2" if proxy.l3 in ['tls_h2'] or proxy.transport in ["grpc", 'h2'] else 'h2,http/1.1' if proxy.l3 == 'tls_h2_h1' else "http/1.1"
-    cdn_forced_host = domain_db.cdn_ip or (domain_db.domain if domain_db.mode != DomainType.reality else hutils.network.get_direct_host_or_ip(4))
+    cdn_forced_host = domain_db.cdn_ip or (domain if domain_db.mode != DomainType.reality else hutils.network.get_direct_host_or_ip(4))
     is_cdn = ProxyCDN.CDN == proxy.cdn or ProxyCDN.Fake == proxy.cdn
     base = {
         'name': name,
@@ -139,7 +148,6 @@ def make_proxy(hconfigs, proxy: Proxy, domain_db: Domain, phttp=80, ptls=443, pp
         'port': port,
         'server': cdn_forced_host,
         'sni': domain_db.servernames if is_cdn and domain_db.servernames else domain,
-        'uuid': str(g.account.uuid),
         'proto': proxy.proto,
         'transport': proxy.transport,
         'proxy_path': hconfigs[ConfigEnum.proxy_path],
@@ -147,18 +155,18 @@ def make_proxy(hconfigs, proxy: Proxy, domain_db: Domain, phttp=80, ptls=443, pp
         'extra_info': f'{domain_db.alias or domain}',
         'fingerprint': hconfigs[ConfigEnum.utls],
         'allow_insecure': domain_db.mode == DomainType.fake or "Fake" in proxy.cdn,
-        'dbe': proxy,
-        'dbdomain': domain_db
+        # plain values instead of the db objects, the skeletons are cached between requests
+        'proxy_cdn': proxy.cdn,
+        'domain_id': domain_db.id,
+        'child_id': child_id,
+        'servernames': domain_db.servernames,
+        'has_auto_ip': getattr(domain_db, 'has_auto_ip', False),
+        'domain_pattern': domain if '*' in domain else None,
     }
     if proxy.proto in ['tuic', 'hysteria2']:
         base['alpn'] = "h3"
         return base
     if proxy.proto in ['wireguard']:
-        base['wg_pub'] = g.account.wg_pub
-        base['wg_pk'] = g.account.wg_pk
-        base['wg_psk'] = g.account.wg_psk
-        base['wg_ipv4'] = hutils.network.add_number_to_ipv4(hconfigs[ConfigEnum.wireguard_ipv4], g.account.id)
-        base['wg_ipv6'] = hutils.network.add_number_to_ipv6(hconfigs[ConfigEnum.wireguard_ipv6], g.account.id)
         base['wg_server_pub'] = hconfigs[ConfigEnum.wireguard_public_key]
         base['wg_noise_trick'] = hconfigs[ConfigEnum.wireguard_noise_trick]
         return base
@@ -167,16 +175,14 @@ def make_proxy(hconfigs, proxy: Proxy, domain_db: Domain, phttp=80, ptls=443, pp
         base['cipher'] = "chacha20-poly1305"
 
     if l3 in ['reality']:
-        base['reality_short_id'] = random.sample(hconfigs[ConfigEnum.reality_short_ids].split(','), 1)[0]
+        # reality_short_id and the random sni are picked per request in add_user_info
         # base['flow']="xtls-rprx-vision"
         base['reality_pbk'] = hconfigs[ConfigEnum.reality_public_key]
         if (domain_db.servernames):
             all_servernames = re.split('[ \t\r\n;,]+', domain_db.servernames)
-            base['sni'] = random.sample(all_servernames, 1)[0]
-            if hconfigs[ConfigEnum.core_type] == "singbox":
-                base['sni'] = all_servernames[0]
+            base['sni'] = all_servernames[0]
         else:
-            base['sni'] = domain_db.domain
+            base['sni'] = domain
 
         del base['host']
         if base.get('fingerprint', 'none') != 'none':
@@ -209,7 +215,6 @@ def make_proxy(hconfigs, proxy: Proxy, domain_db: Domain, phttp=80, ptls=443, pp
 
     if base["proto"] in ['v2ray', 'ss', 'ssr']:
         base['cipher'] = hconfigs[ConfigEnum.shadowsocks2022_method]
-        base['password'] = f'{hutils.encode.do_base_64(hconfigs[ConfigEnum.shared_secret].replace("-",""))}:{hutils.encode.do_base_64(g.account.uuid.replace("-",""))}'
 
     if base["proto"] == "ssr":
         base["ssr-obfs"] = "tls1.2_ticket_auth"
@@ -292,13 +297,77 @@ def make_proxy(hconfigs, proxy: Proxy, domain_db: Domain, phttp=80, ptls=443, pp
         base['alpn'] = 'http/1.1'
         return base
     if ProxyProto.ssh == proxy.proto:
-        base['private_key'] = g.account.ed25519_private_key
         base['host_key'] = hiddify.get_hostkeys(False)
         # base['ssh_port'] = hconfig(ConfigEnum.ssh_server_port)
         return base
     return {'name': name, 'msg': 'not valid', 'type': 'error', 'proto': proxy.proto}
 
 
+# values which change on every request, they are filled by fill_per_request_values when
+# the body is served so the rendered subscriptions can be cached
+RANDOM_HASH_MARK = '__hiddify_random_hash__'
+NOW_MARK = '__hiddify_now__'
+
+
+def fill_per_request_values(body: str) -> str:
+    if RANDOM_HASH_MARK in body:
+        body = body.replace(RANDOM_HASH_MARK, f'{random.randint(0, 1000000)}')
+    if NOW_MARK in body:
+        body = body.replace(NOW_MARK, datetime.datetime.now().strftime(f"%H.%M--%Y.%m.%d.time:%H%M"))
+    return body
+
+
+def mark_random_subscription():
+    '''The subscription has random choices (e.g. the reality short id) and should not be cached'''
+    g.random_subscription = True
+
+
+def get_domain_pattern(domain_db) -> str:
+    '''The stored domain, before the wildcard of it is replaced (see get_wildcard_domain)'''
+    return getattr(domain_db, 'domain_pattern', None) or domain_db.domain
+
+
+def get_wildcard_domain(pattern: str) -> str:
+    '''Replaces the * of a wildcard domain with a random label, the same one in the whole request'''
+    domains = g.setdefault('wildcard_domains', {})
+    if pattern not in domains:
+        domains[pattern] = pattern.replace("*", hutils.random.get_random_string(5, 15))
+    mark_random_subscription()
+    return domains[pattern]
+
+
+def add_user_info(pinfo: dict, user, hconfigs) -> dict:
+    '''Returns a copy of a proxy skeleton with the user fields (and per request random choices) filled'''
+    res = {**pinfo, 'uuid': str(user.uuid)}
+    if res['proto'] == ProxyProto.wireguard:
+        res['wg_pub'] = user.wg_pub
+        res['wg_pk'] = user.wg_pk
+        res['wg_psk'] = user.wg_psk
+        res['wg_ipv4'] = hutils.network.add_number_to_ipv4(hconfigs[ConfigEnum.wireguard_ipv4], user.id)
+        res['wg_ipv6'] = hutils.network.add_number_to_ipv6(hconfigs[ConfigEnum.wireguard_ipv6], user.id)
+    if res['proto'] in ['v2ray', 'ss', 'ssr']:
+        res['password'] = f'{hutils.encode.do_base_64(hconfigs[ConfigEnum.shared_secret].replace("-",""))}:{hutils.encode.do_base_64(user.uuid.replace("-",""))}'
+    if res['proto'] == ProxyProto.ssh:
+        res['private_key'] = user.ed25519_private_key
+    if res['l3'] in ['reality']:
+        short_ids = hconfigs[ConfigEnum.reality_short_ids].split(',')
+        res['reality_short_id'] = random.sample(short_ids, 1)[0]
+        servernames = res['servernames']
+        if servernames and hconfigs[ConfigEnum.core_type] != "singbox":
+            servernames = re.split('[ \t\r\n;,]+', servernames)
+            res['sni'] = random.sample(servernames, 1)[0]
+            if len(servernames) > 1:
+                mark_random_subscription()
+        if len(short_ids) > 1:
+            mark_random_subscription()
+    if pattern := res.get('domain_pattern'):
+        domain = get_wildcard_domain(pattern)
+        for k in ['host', 'sni', 'server', 'extra_info']:
+            if isinstance(res.get(k), str):
+                res[k] = res[k].replace(pattern, domain)
+    return res
+
+
 def to_link(proxy):
     if 'error' in proxy:
         return proxy
@@ -491,11 +560,11 @@ def to_clash(proxy, meta_or_normal):
             return {'name': name, 'msg': "xtls not supported in clash", 'type': 'debug'}
         if proxy['transport'] == "shadowtls":
             return {'name': name, 'msg': "shadowtls not supported in clash", 'type': 'debug'}
-    if proxy['l3'] == ProxyL3.tls_h2 and proxy['proto'] in [ProxyProto.vmess, ProxyProto.vless] and proxy['dbe'].cdn == ProxyCDN.direct:
+    if proxy['l3'] == ProxyL3.tls_h2 and proxy['proto'] in [ProxyProto.vmess, ProxyProto.vless] and proxy['proxy_cdn'] == ProxyCDN.direct:
         return {'name': name, 'msg': "bug tls_h2 vmess and vless in clash meta", 'type': 'warning'}
     base = {}
     # vmess ws
-    base["name"] = f"""{proxy['extra_info']} {proxy["name"]} § {proxy['port']} {proxy["dbdomain"].id}"""
+    base["name"] = f"""{proxy['extra_info']} {proxy["name"]} § {proxy['port']} {proxy["domain_id"]}"""
     base["type"] = str(proxy["proto"])
     base["server"] = proxy["server"]
     base["port"] = proxy["port"]
@@ -612,24 +681,34 @@ def to_clash(proxy, meta_or_normal):
     return base
 
 
-def get_clash_config_names(meta_or_normal, domains):
+def get_all_clash_proxies(meta_or_normal, domains):
     allp = []
     for pinfo in get_all_validated_proxies(domains):
         clash = to_clash(pinfo, meta_or_normal)
         if 'msg' not in clash:
-            allp.append(clash['name'])
+            allp.append(clash)
+    return allp
 
-    return yaml.dump(allp, sort_keys=False)
 
+def get_clash_config_names(meta_or_normal, domains, clash_proxies=None):
+    if clash_proxies is None:
+        clash_proxies = get_all_clash_proxies(meta_or_normal, domains)
+    return yaml.dump([p['name'] for p in clash_proxies], sort_keys=False)
 
-def get_all_clash_configs(meta_or_normal, domains):
-    allp = []
-    for pinfo in get_all_validated_proxies(domains):
-        clash = to_clash(pinfo, meta_or_normal)
-        if 'msg' not in clash:
-            allp.append(clash)
 
-    return yaml.dump({"proxies": allp}, sort_keys=False)
+def get_all_clash_configs(meta_or_normal, domains, clash_proxies=None):
+    if clash_proxies is None:
+        clash_proxies = get_all_clash_proxies(meta_or_normal, domains)
+    return yaml.dump({"proxies": clash_proxies}, sort_keys=False)
+
+
+def get_clash_render_data(meta_or_normal, domains):
+    '''Builds the clash proxies once for all the places they are used in the clash templates'''
+    clash_proxies = get_all_clash_proxies(meta_or_normal, domains)
+    return {
+        'clash_names': get_clash_config_names(meta_or_normal, domains, clash_proxies),
+        'clash_configs': get_all_clash_configs(meta_or_normal, domains, clash_proxies)
+    }
 
 
 def to_singbox(proxy):
@@ -642,7 +721,7 @@ def to_singbox(proxy):
     base = {}
     all_base.append(base)
     # vmess ws
-    base["tag"] = f"""{proxy['extra_info']} {proxy["name"]} § {proxy['port']} {proxy["dbdomain"].id}"""
+    base["tag"] = f"""{proxy['extra_info']} {proxy["name"]} § {proxy['port']} {proxy["domain_id"]}"""
     base["type"] = str(proxy["proto"])
     base["server"] = proxy["server"]
     base["server_port"] = int(proxy["port"])
@@ -926,9 +1005,40 @@ def add_singbox_ssh(all_base, proxy):
     all_base.append(socks_front)
 
 
-def make_full_singbox_config(domains, **kwargs):
+# parsed base_singbox_config.json.j2, see get_singbox_base_config
+singbox_base_configs = LocalCache(maxsize=64, ttl=600)
+
+
+def get_singbox_base_config() -> dict:
+    '''
+    Returns a private copy of the parsed base singbox config. The template only depends on
+    the configs and the singbox version of the client, so it is rendered once per generation.
+    '''
     ua = hutils.flask.get_user_agent()
-    base_config = json.loads(render_template('base_singbox_config.json.j2'))
+    key = (Child.current.id, get_config_generation(), ua['is_singbox'], ua['singbox_version'])
+    base_config = singbox_base_configs.get(key)
+    if base_config is None:
+        base_config = json.loads(render_template('base_singbox_config.json.j2'))
+        singbox_base_configs.set(key, base_config)
+    base_config = copy_json(base_config)
+    for section in base_config.get('experimental', {}).values():
+        if isinstance(section, dict) and 'cache_id' in section:
+            section['cache_id'] = g.account.uuid
+    return base_config
+
+
+def copy_json(obj):
+    '''Faster deepcopy for the json like objects'''
+    if isinstance(obj, dict):
+        return {k: copy_json(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [copy_json(v) for v in obj]
+    return obj
+
+
+def make_full_singbox_config(domains, compact=False, **kwargs):
+    ua = hutils.flask.get_user_agent()
+    base_config = get_singbox_base_config()
     allphttp = [p for p in request.args.get("phttp", "").split(',') if p]
     allptls = [p for p in request.args.get("ptls", "").split(',') if p]
 
@@ -958,13 +1068,21 @@ def make_full_singbox_config(domains, **kwargs):
         "tolerance": 200
     }
     base_config['outbounds'].insert(1, smart)
-    res = json.dumps(base_config, indent=4, cls=CustomEncoder)
+    if compact:
+        res = json.dumps(base_config, separators=(',', ':'), cls=CustomEncoder)
+    else:
+        res = json.dumps(base_config, indent=4, cls=CustomEncoder)
     # if ua['is_hiddify']:
     #     res = res[:-1]+',"experimental": {}}'
     return res
 
 
-def make_v2ray_configs(user, user_activate, domains, expire_days, ip_debug, db_domain, has_auto_cdn, asn, profile_title, **kwargs):
+def make_v2ray_configs(**kwargs):
+    return fill_per_request_values("".join(iter_v2ray_configs(**kwargs)))
+
+
+def iter_v2ray_configs(user, user_activate, domains, expire_days, ip_debug, db_domain, has_auto_cdn, asn, profile_title, **kwargs):
+    '''Same as make_v2ray_configs but yields the lines one by one to be streamed'''
     res = []
 
     ua = hutils.flask.get_user_agent()
@@ -972,7 +1090,7 @@ def make_v2ray_configs(user, user_activate, domains, expire_days, ip_debug, db_d
 
         if not ua['is_hiddify']:
 
-            fake_ip_for_sub_link = datetime.datetime.now().strftime(f"%H.%M--%Y.%m.%d.time:%H%M")
+            fake_ip_for_sub_link = NOW_MARK  # see fill_per_request_values
             # if ua['app'] == "Fair1":
             #     res.append(f'trojan://1@{fake_ip_for_sub_link}?sni=fake_ip_for_sub_link&security=tls#{round(user.current_usage_GB,3)}/{user.usage_limit_GB}GB_Remain:{expire_days}days')
             # else:
@@ -1004,30 +1122,77 @@ def make_v2ray_configs(user, user_activate, domains, expire_days, ip_debug, db_d
             res.append('trojan://1@1.1.1.1#' + hutils.encode.url_encode('✖بسته شما به پایان رسید'))
         else:
             res.append('trojan://1@1.1.1.1#' + hutils.encode.url_encode('✖Package_Ended'))
-        return "\n".join(res)
+        yield "\n".join(res)
+        return
 
-    for pinfo in get_all_validated_proxies(domains):
+    sep = ""
+    if res:
+        yield "\n".join(res)
+        sep = "\n"
+    for pinfo in iter_validated_proxies(domains):
         link = to_link(pinfo)
         if 'msg' not in link:
-            res.append(link)
-    return "\n".join(res)
+            yield sep + link
+            sep = "\n"
+
+
+# compiled proxy plans, see get_proxy_plan
+proxy_plans = LocalCache(maxsize=256, ttl=600)
 
 
 def get_all_validated_proxies(domains):
-    allp = []
+    return list(iter_validated_proxies(domains))
+
+
+def iter_validated_proxies(domains):
     allphttp = [p for p in request.args.get("phttp", "").split(',') if p]
     allptls = [p for p in request.args.get("ptls", "").split(',') if p]
-    added_ip = {}
     configsmap = {}
+    for pinfo in get_proxy_plan(domains, allphttp, allptls):
+        child_id = pinfo['child_id']
+        if child_id not in configsmap:
+            configsmap[child_id] = get_hconfigs(child_id)
+        yield add_user_info(pinfo, g.account, configsmap[child_id])
+
+
+def get_proxy_plan(domains, allphttp, allptls):
+    '''
+    Returns the validated, user independent proxy skeletons for the domains.
+    The plan is shared between all users of this worker and is rebuilt when the
+    config generation, the domains, their ips or the available proxies change.
+    '''
     proxeismap = {}
+    for d in domains:
+        if d.child_id not in proxeismap:
+            proxeismap[d.child_id] = all_proxies(d.child_id)
+    key = (
+        Child.current.id,
+        get_config_generation(),
+        tuple((d.id, d.child_id, get_domain_pattern(d), d.alias, d.mode, d.cdn_ip, d.grpc, d.servernames, getattr(d, 'has_auto_ip', False)) for d in domains),
+        tuple((child_id, tuple((p.id, p.name, p.proto, p.l3, p.transport, p.cdn) for p in proxies)) for child_id, proxies in proxeismap.items()),
+        tuple(allphttp),
+        tuple(allptls)
+    )
+    domain_ips = hutils.network.resolve_domains([get_domain_pattern(d) for d in domains])
+    key += (tuple(domain_ips.items()),)
+    plan = proxy_plans.get(key)
+    if plan is None:
+        plan = compile_proxy_plan(domains, proxeismap, allphttp, allptls, domain_ips)
+        proxy_plans.set(key, plan)
+    return plan
+
+
+def compile_proxy_plan(domains, proxeismap, allphttp, allptls, domain_ips):
+    allp = []
+    added_ip = {}
+    configsmap = {}
     for d in domains:
         if d.child_id not in configsmap:
             configsmap[d.child_id] = get_hconfigs(d.child_id)
-            proxeismap[d.child_id] = all_proxies(d.child_id)
         hconfigs = configsmap[d.child_id]
 
-        ip = hutils.network.get_domain_ip(d.domain, version=4)
-        ip6 = hutils.network.get_domain_ip(d.domain, version=6)
+        ip = domain_ips.get((get_domain_pattern(d), 4))
+        ip6 = domain_ips.get((get_domain_pattern(d), 6))
         ips = [x for x in [ip, ip6] if x is not None]
         for type in proxeismap[d.child_id]:
             noDomainProxies = False
@@ -1073,7 +1238,7 @@ def get_all_validated_proxies(domains):
                         options.append({'phttp': phttp, 'ptls': ptls})
 
             for opt in options:
-                pinfo = make_proxy(hconfigs, type, d, **opt)
+                pinfo = make_proxy_skeleton(hconfigs, type, d, **opt)
                 if 'msg' not in pinfo:
                     allp.append(pinfo)
     return allp
@@ -1,9 +1,10 @@
 import user_agents
 import datetime
-import random
-import re
+import hashlib
+import gzip
+import zlib
 
-from flask import render_template, request, Response, g
+from flask import render_template, request, Response, g, stream_with_context
 from apiflask import abort
 from . import link_maker
 from flask_classful import FlaskView, route
@@ -15,9 +16,14 @@ from hiddifypanel.auth import login_required
 from hiddifypanel.database import db
 from hiddifypanel.panel import hiddify
 from hiddifypanel.models import *
-from hiddifypanel import hutils
+from hiddifypanel import Events, hutils
 from hiddifypanel import cache
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 
 class UserView(FlaskView):
 
@@ -97,20 +103,19 @@ class UserView(FlaskView):
     def get_proper_config(self):
         if g.user_agent['is_browser']:
             return None
-        ua = request.user_agent.string
-        if g.user_agent['is_singbox'] or re.match('^(HiddifyNext|Dart|SFI|SFA)', ua, re.IGNORECASE):
+        if g.user_agent['is_singbox']:
             return self.full_singbox()
 
-        if re.match('^(Clash-verge|Clash-?Meta|Stash|NekoBox|NekoRay|Pharos|hiddify-desktop)', ua, re.IGNORECASE):
+        if g.user_agent['is_clash_meta']:
             return self.clash_config(meta_or_normal="meta")
-        if re.match('^(Clash|Stash)', ua, re.IGNORECASE):
+        if g.user_agent['is_clash']:
             return self.clash_config(meta_or_normal="normal")
 
         # if 'HiddifyNext' in ua or 'Dart' in ua:
         #     return self.clash_config(meta_or_normal="meta")
 
         # if any([p in ua for p in ['FoXray', 'HiddifyNG','Fair%20VPN' ,'v2rayNG', 'SagerNet']]):
-        if re.match('^(Hiddify|FoXray|Fair|v2rayNG|SagerNet|Shadowrocket|V2Box|Loon|Liberty)', ua, re.IGNORECASE):
+        if g.user_agent['is_v2ray']:
             return self.all_configs(base64=True)
 
     @route('/clash/<meta_or_normal>/proxies.yml')
@@ -120,10 +125,20 @@ class UserView(FlaskView):
         mode = request.args.get("mode")
         domain = request.args.get("domain", None)
 
-        c = get_common_data(g.account.uuid, mode, filter_domain=domain)
-        resp = Response(render_template('clash_proxies.yml',
-                        meta_or_normal=meta_or_normal, **c))
+        etag = get_subscription_etag('clash_proxies', meta_or_normal)
+        if request.if_none_match.contains_weak(etag):
+            resp = Response(status=304)
+            resp.set_etag(etag, weak=True)
+            return resp
+
+        if not (body := get_rendered_subscription(etag)):
+            c = get_common_data(g.account.uuid, mode, filter_domain=domain)
+            clash_data = link_maker.get_clash_render_data(meta_or_normal, c['domains'])
+            body = render_template('clash_proxies.yml', meta_or_normal=meta_or_normal, **c, **clash_data)
+            save_rendered_subscription(etag, body)
+        resp = Response(link_maker.fill_per_request_values(body))
         resp.mimetype = "text/plain"
+        resp.set_etag(etag, weak=True)
 
         return resp
 
@@ -170,30 +185,39 @@ class UserView(FlaskView):
     @login_required(roles={Role.user})
     def clash_config(self, meta_or_normal="normal", typ="all.yml"):
         mode = request.args.get("mode")
+        etag = get_subscription_etag('clash_config', meta_or_normal, typ)
+        if resp := head_or_not_modified(etag):
+            return resp
+        if resp := get_rendered_subscription(etag):
+            return add_headers(link_maker.fill_per_request_values(resp), get_headers_data(g.account.uuid), etag=etag)
 
         c = get_common_data(g.account.uuid, mode)
 
-        hash_rnd = random.randint(0, 1000000)  # hash(f'{c}')
-        if request.method == 'HEAD':
-            resp = ""
-        else:
-            resp = render_template(
-                'clash_config.yml', typ=typ, meta_or_normal=meta_or_normal, **c, hash=hash_rnd)
+        hash_rnd = link_maker.RANDOM_HASH_MARK  # filled per request, see fill_per_request_values
+        clash_data = link_maker.get_clash_render_data(meta_or_normal, c['domains'])
+        resp = render_template(
+            'clash_config.yml', typ=typ, meta_or_normal=meta_or_normal, **c, **clash_data, hash=hash_rnd)
+        save_rendered_subscription(etag, resp)
 
-        return add_headers(resp, c)
+        return add_headers(link_maker.fill_per_request_values(resp), c, etag=etag)
 
     @ route('/full-singbox.json', methods=["GET", "HEAD"])
     @login_required(roles={Role.user})
     def full_singbox(self):
         mode = "new"  # request.args.get("mode")
+        etag = get_subscription_etag('full_singbox')
+        if resp := head_or_not_modified(etag, 'application/json'):
+            return resp
+        if resp := get_rendered_subscription(etag):
+            return compress_response(add_headers(resp, get_headers_data(g.account.uuid), 'application/json', etag=etag))
         c = get_common_data(g.account.uuid, mode)
         # response.content_type = 'text/plain';
-        if request.method == 'HEAD':
-            resp = ""
-        else:
-            resp = link_maker.make_full_singbox_config(**c)
+        # apps do not need the indents, browsers get them unless compact=true is asked
+        compact = request.args.get("compact", f'{not g.user_agent["is_browser"]}').lower() == "true"
+        resp = link_maker.make_full_singbox_config(**c, compact=compact)
+        save_rendered_subscription(etag, resp)
 
-        return add_headers(resp, c, 'application/json')
+        return compress_response(add_headers(resp, c, 'application/json', etag=etag))
 
     @ route('/singbox.json', methods=["GET", "HEAD"])
     @login_required(roles={Role.user})
@@ -216,17 +240,22 @@ class UserView(FlaskView):
     def all_configs(self, base64=False):
         mode = "new"  # request.args.get("mode")
         base64 = base64 or request.args.get("base64", "").lower() == "true"
-        c = get_common_data(g.account.uuid, mode)
-        # response.content_type = 'text/plain';
-        if request.method == 'HEAD':
-            resp = ""
+        etag = get_subscription_etag('all_configs', base64)
+        if resp := head_or_not_modified(etag):
+            return resp
+        if body := get_rendered_subscription(etag):
+            c = get_headers_data(g.account.uuid)
+            resp = [body]
         else:
+            c = get_common_data(g.account.uuid, mode)
+            # response.content_type = 'text/plain';
             # render_template('all_configs.txt', **c, base64=hutils.encode.do_base_64)
-            resp = link_maker.make_v2ray_configs(**c)
-
+            resp = stream_and_save_rendered_subscription(etag, link_maker.iter_v2ray_configs(**c))
+        # the per request values are filled after saving and before the encoding
+        resp = (link_maker.fill_per_request_values(chunk) for chunk in resp)
         if base64:
-            resp = hutils.encode.do_base_64(resp)
-        return add_headers(resp, c)
+            resp = hutils.encode.iter_base_64(resp)
+        return add_headers(stream_with_context(resp), c, etag=etag)
 
     @ route("/offline.html")
     @login_required(roles={Role.user})
@@ -246,10 +275,9 @@ class UserView(FlaskView):
 #     return resp.decode()
 
 
-# @cache.cache(ttl=300)
-def get_domain_information(no_domain=False, filter_domain=None, alternative=None):
+def find_domains(no_domain=False, filter_domain=None, alternative=None):
+    '''Only looks up the requested domain and the domains to show, see get_domain_information'''
     domains = []
-    default_asn = request.args.get("asn")
     if filter_domain:
         domain = filter_domain
         db_domain = Domain.query.filter(Domain.domain == domain).first() or Domain(
@@ -270,6 +298,13 @@ def get_domain_information(no_domain=False, filter_domain=None, alternative=None
             hutils.flask.flash(_("This domain does not exist in the panel!" + domain))
 
         domains = db_domain.show_domains or Domain.query.filter(Domain.sub_link_only != True).all()
+    return domains, db_domain
+
+
+# @cache.cache(ttl=300)
+def get_domain_information(no_domain=False, filter_domain=None, alternative=None):
+    default_asn = request.args.get("asn")
+    domains, db_domain = find_domains(no_domain, filter_domain, alternative)
 
     has_auto_cdn = False
     for d in domains:
@@ -283,7 +318,8 @@ def get_domain_information(no_domain=False, filter_domain=None, alternative=None
                 d.cdn_ip, d.mode == DomainType.auto_cdn_ip, default_asn)
             # print("autocdn ip mode ", d.cdn_ip)
         if "*" in d.domain:
-            d.domain = d.domain.replace("*", hutils.random.get_random_string(5, 15))
+            d.domain_pattern = d.domain
+            d.domain = link_maker.get_wildcard_domain(d.domain)
 
     if len(domains) == 0:
         domains = [Domain(id=0, domain=alternative, mode=DomainType.direct, cdn_ip='', show_domains=[], child_id=0)]
@@ -298,30 +334,19 @@ def get_common_data(user_uuid, mode, no_domain=False, filter_domain=None):
     domains, db_domain, has_auto_cdn = get_domain_information(no_domain, filter_domain, request.host)
 
     domain = db_domain.domain
-    user: User = g.account if g.account.uuid == user_uuid else User.by_uuid(f'{user_uuid}')
-    if user is None:
-        abort(401, "Invalid User")
-
-    package_mode_dic = {
-        UserMode.daily: 1,
-        UserMode.weekly: 7,
-        UserMode.monthly: 30
-
-    }
+    user = get_user(user_uuid)
 
     expire_days = user.remaining_days
     reset_days = user.days_to_reset()
     if reset_days >= expire_days:
         reset_days = 1000
 
-    expire_s = int((datetime.date.today() + datetime.timedelta(days=expire_days) - datetime.date(1970, 1, 1)).total_seconds())
+    expire_s = get_expire_s(expire_days)
 
     user_ip = hutils.network.auto_ip_selector.get_real_user_ip()
     asn = hutils.network.auto_ip_selector.get_asn_short_name(user_ip)
-    profile_title = f'{db_domain.alias or db_domain.domain} {user.name}'
+    profile_title = get_profile_title(db_domain, user, has_auto_cdn, asn)
     profile_url = hiddify.get_account_panel_link(user, request.host)
-    if has_auto_cdn and asn != 'unknown':
-        profile_title += f" {asn}"
 
     return {
         # 'direct_host':direct_host,
@@ -354,9 +379,156 @@ def get_common_data(user_uuid, mode, no_domain=False, filter_domain=None):
     }
 
 
-def add_headers(res, c, mimetype="text/plain"):
+def get_user(user_uuid) -> User:
+    user: User = g.account if g.account.uuid == user_uuid else User.by_uuid(f'{user_uuid}')
+    if user is None:
+        abort(401, "Invalid User")
+    return user
+
+
+def get_expire_s(expire_days):
+    return int((datetime.date.today() + datetime.timedelta(days=expire_days) - datetime.date(1970, 1, 1)).total_seconds())
+
+
+def get_profile_title(db_domain, user, has_auto_cdn, asn):
+    profile_title = f'{db_domain.alias or db_domain.domain} {user.name}'
+    if has_auto_cdn and asn != 'unknown':
+        profile_title += f" {asn}"
+    return profile_title
+
+
+def get_headers_data(user_uuid):
+    '''The part of get_common_data used by add_headers, without preparing the domains'''
+    user = get_user(user_uuid)
+    domains, db_domain = find_domains(alternative=request.host)
+    has_auto_cdn = any(d.mode == DomainType.auto_cdn_ip or d.cdn_ip for d in domains)
+    asn = hutils.network.auto_ip_selector.get_asn_short_name(hutils.network.auto_ip_selector.get_real_user_ip())
+    return {
+        'user': user,
+        'profile_title': get_profile_title(db_domain, user, has_auto_cdn, asn),
+        'usage_limit_b': int(user.usage_limit_GB * 1024 * 1024 * 1024),
+        'usage_current_b': int(user.current_usage_GB * 1024 * 1024 * 1024),
+        'expire_s': get_expire_s(user.remaining_days),
+    }
+
+
+def get_subscription_etag(*fmt) -> str:
+    '''
+    Fingerprint of everything the subscription content depends on. It has to be cheap,
+    so it is computed before get_common_data and used as a weak etag.
+    '''
+    user = g.account
+    user_ip = hutils.network.auto_ip_selector.get_real_user_ip()
+    parts = [
+        fmt,
+        request.host,
+        sorted(request.args.items(multi=True)),
+        sorted((k, f'{v}') for k, v in g.user_agent.items()),
+        hutils.network.auto_ip_selector.get_asn_short_name(user_ip),
+        datetime.date.today(),
+        get_config_generation(),
+        (user.uuid, user.name, user.lang, user.enable, user.is_active, user.mode, user.usage_limit, user.current_usage,
+         user.package_days, user.start_date, user.wg_pub, user.ed25519_public_key),
+        db.session.query(Domain.id, Domain.child_id, Domain.domain, Domain.alias, Domain.mode, Domain.sub_link_only,
+                         Domain.cdn_ip, Domain.grpc, Domain.servernames).order_by(Domain.id).all(),
+        db.session.query(ShowDomain.c.domain_id, ShowDomain.c.related_id).all(),
+        db.session.query(Proxy.id, Proxy.child_id, Proxy.name, Proxy.enable, Proxy.proto, Proxy.l3, Proxy.transport, Proxy.cdn).order_by(Proxy.id).all(),
+    ]
+    return hashlib.sha1(f'{parts}'.encode()).hexdigest()
+
+
+RENDERED_SUBSCRIPTION_TTL = 3600
+RENDERED_SUBSCRIPTION_MAX = 16
+
+
+def rendered_subscription_key(user_uuid):
+    return f'h:rendered-sub:{user_uuid}'
+
+
+def get_rendered_subscription(etag) -> str | None:
+    '''
+    Body of a subscription rendered before with the same etag. Bodies of each user are kept
+    in one redis hash so changing the user drops all of them at once.
+    '''
+    if g.user_agent['is_browser']:  # browsers get the ip debug info
+        return None
+    body = cache.redis_call(lambda: cache.redis_client.hget(rendered_subscription_key(g.account.uuid), etag))
+    return zlib.decompress(body).decode() if body else None
+
+
+def save_rendered_subscription(etag, body: str):
+    save_compressed_subscription(etag, zlib.compress(body.encode()))
+
+
+def stream_and_save_rendered_subscription(etag, chunks):
+    '''Yields the chunks and saves the whole body after the last one'''
+    compressor = zlib.compressobj()
+    compressed = []
+    for chunk in chunks:
+        compressed.append(compressor.compress(chunk.encode()))
+        yield chunk
+    compressed.append(compressor.flush())
+    save_compressed_subscription(etag, b''.join(compressed))
+
+
+def save_compressed_subscription(etag, body: bytes):
+    if g.user_agent['is_browser'] or g.get('random_subscription') or g.get('exporting_subscriptions'):
+        return
+    key = rendered_subscription_key(g.account.uuid)
+
+    def save():
+        # old etags of the user (previous usage, day or generation) are only removed together
+        if cache.redis_client.hlen(key) >= RENDERED_SUBSCRIPTION_MAX:
+            cache.redis_client.delete(key)
+        pipe = cache.redis_client.pipeline()
+        pipe.hset(key, etag, body)
+        pipe.expire(key, RENDERED_SUBSCRIPTION_TTL)
+        pipe.execute()
+    cache.redis_call(save)
+
+
+def invalidate_rendered_subscriptions(user=None, **kwargs):
+    '''
+    Drops the rendered subscriptions of the user. Config, domain and proxy changes
+    (and user=None) bump the config generation which is a part of every etag instead.
+    '''
+    if user:
+        # bodies which could not be dropped while redis is down expire after RENDERED_SUBSCRIPTION_TTL
+        cache.redis_call(lambda: cache.redis_client.delete(rendered_subscription_key(user.uuid)))
+    else:
+        bump_config_generation()
+
+
+Events.user_changed.subscribe(invalidate_rendered_subscriptions)
+
+
+def head_or_not_modified(etag, mimetype="text/plain"):
+    '''Answers HEAD and matching If-None-Match requests without generating the subscription'''
+    if request.method != 'HEAD' and not request.if_none_match.contains_weak(etag):
+        return None
+    resp = add_headers("", get_headers_data(g.account.uuid), mimetype, etag=etag)
+    if request.method != 'HEAD':
+        resp.status_code = 304
+    return resp
+
+
+def compress_response(resp: Response) -> Response:
+    '''Compresses the body with brotli (if installed) or gzip when the client accepts it'''
+    resp.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+    if not encoding or resp.content_length is None or resp.content_length < 1024:
+        return resp
+    data = resp.get_data()
+    resp.set_data(brotli.compress(data, quality=5) if encoding == 'br' else gzip.compress(data, compresslevel=6))
+    resp.headers['Content-Encoding'] = encoding
+    return resp
+
+
+def add_headers(res, c, mimetype="text/plain", etag=None):
     resp = Response(res)
     resp.mimetype = mimetype
+    if etag:
+        resp.set_etag(etag, weak=True)
     resp.headers['Subscription-Userinfo'] = f"upload=0;download={c['usage_current_b']};total={c['usage_limit_b']};expire={c['expire_s']}"
     resp.headers['profile-web-page-url'] = request.base_url.rsplit('/', 1)[0].replace("http://", "https://") + "/"
 
@@ -0,0 +1,91 @@
+'''
+Import and init timings of the app startup, enabled by `hiddifypanel --profile-startup <command>`
+or the HIDDIFY_PROFILE_STARTUP=1 environment variable (e.g. for the uwsgi workers).
+'''
+from contextlib import contextmanager
+import importlib.abc
+import os
+import sys
+import time
+
+_modules = {}  # module -> [total seconds, self seconds]
+_steps = {}  # init step -> seconds
+_stack = []
+_enabled = False
+
+
+class _TimedLoader:
+    def __init__(self, loader):
+        self.__loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self.__loader, name)
+
+    def create_module(self, spec):
+        return self.__loader.create_module(spec)
+
+    def exec_module(self, module):
+        _stack.append(0.0)  # time spent in the nested imports
+        start = time.perf_counter()
+        try:
+            self.__loader.exec_module(module)
+        finally:
+            total = time.perf_counter() - start
+            nested = _stack.pop()
+            if _stack:
+                _stack[-1] += total
+            _modules[module.__name__] = [total, total - nested]
+
+
+class _TimedFinder(importlib.abc.MetaPathFinder):
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimedLoader(spec.loader)
+                return spec
+        return None
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def enable():
+    '''Should be called before importing hiddifypanel.base'''
+    global _enabled
+    if not _enabled:
+        _enabled = True
+        sys.meta_path.insert(0, _TimedFinder())
+
+
+@contextmanager
+def step(name: str):
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _steps[name] = _steps.get(name, 0) + time.perf_counter() - start
+
+
+def report(limit: int = 30):
+    if not _enabled:
+        return
+    out = sys.stderr
+    print(f"Startup profile: {len(_modules)} modules imported", file=out)
+    print(f"{'self(ms)':>10} {'total(ms)':>10}  module", file=out)
+    for name, (total, own) in sorted(_modules.items(), key=lambda m: -m[1][1])[:limit]:
+        print(f"{own * 1000:10.1f} {total * 1000:10.1f}  {name}", file=out)
+    print(f"{'init(ms)':>10}  step", file=out)
+    for name, seconds in _steps.items():
+        print(f"{seconds * 1000:10.1f}  {name}", file=out)
+
+
+if os.environ.get('HIDDIFY_PROFILE_STARTUP') == '1' or '--profile-startup' in sys.argv:
+    enable()
@@ -0,0 +1,292 @@
+'''
+Benchmark of the subscription generation.
+
+Builds a synthetic sqlite panel with N domains, M proxies, K ports and U users, stubs
+redis (fakeredis) and dns, drives the UserView endpoints with the flask test client and
+measures the link_maker functions directly. The result is written as json so it can be
+compared between releases.
+
+    pip install fakeredis
+    python scripts/benchmark_subscriptions.py --domains 10 --proxies 40 --ports 3 --users 200 -o bench.json
+    python scripts/benchmark_subscriptions.py --compare old.json bench.json
+'''
+import argparse
+import base64
+import datetime
+import hashlib
+import ipaddress
+import json
+import os
+import platform
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+FORMATS = {
+    'all.txt': ('/all.txt', 'v2rayNG/1.8.12'),
+    'sub64': ('/sub64', 'v2rayNG/1.8.12'),
+    'singbox': ('/full-singbox.json', 'SFA/1.8.0'),
+    'clash': ('/clash/normal/all.yml', 'Clash/1.18.0'),
+    'clashmeta': ('/clash/meta/all.yml', 'ClashMeta/1.16.0'),
+    'clash_proxies': ('/clash/meta/proxies.yml', 'ClashMeta/1.16.0'),
+}
+SERVER_IP = '198.51.100.1'
+
+
+def stub_redis():
+    import redis
+    import fakeredis
+    server = fakeredis.FakeServer()
+    redis.from_url = lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs)
+
+
+def fake_ip(host: str) -> str:
+    try:
+        return str(ipaddress.ip_address(host.strip('[]')))
+    except ValueError:
+        digest = hashlib.sha1(host.encode()).digest()
+        return f'203.0.{digest[0] % 64}.{digest[1] % 250 + 1}'
+
+
+def stub_dns():
+    socket.gethostbyname = fake_ip
+    getaddrinfo = socket.getaddrinfo
+
+    def fake_getaddrinfo(host, port, family=0, *args, **kwargs):
+        if host is None or host in ('localhost',):
+            return getaddrinfo(host, port, family, *args, **kwargs)
+        if family == socket.AF_INET6:
+            return [(socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('2001:db8::1', port or 0, 0, 0))]
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (fake_ip(host), port or 0))]
+    socket.getaddrinfo = fake_getaddrinfo
+
+
+def stub_network():
+    '''Replaces the functions of hutils.network which need internet'''
+    from hiddifypanel.hutils import network
+    from hiddifypanel.hutils.network import net
+    stubs = {
+        'get_ips': lambda version: [ipaddress.ip_address(SERVER_IP)] if version == 4 else [],
+        'get_ip': lambda version, retry=5: ipaddress.ip_address(SERVER_IP) if version == 4 else None,
+        'get_ip_str': lambda version, retry=5: SERVER_IP if version == 4 else None,
+        'get_direct_host_or_ip': lambda prefer_version: SERVER_IP,
+        'get_random_domains': lambda count=1, retry=3: ['www.example.com'] * count,
+        'is_domain_reality_friendly': lambda domain: True,
+        'is_domain_support_h2': lambda sni, server='': True,
+        'is_domain_support_tls_13': lambda domain: True,
+        'is_domain_use_letsencrypt': lambda domain: True,
+    }
+    for name, fn in stubs.items():
+        setattr(net, name, fn)
+        setattr(network, name, fn)
+
+
+def setup_app(workdir):
+    db_path = os.path.join(workdir, 'bench.db')
+    cfg_path = os.path.join(workdir, 'app.cfg')
+    with open(cfg_path, 'w') as f:
+        f.write(f'SQLALCHEMY_DATABASE_URI=sqlite:///{db_path}\nHIDDIFY_CONFIG_PATH={workdir}/\nSECRET_KEY=bench\n')
+    os.environ['HIDDIFY_CFG_PATH'] = cfg_path
+
+    stub_redis()
+    stub_dns()
+    stub_network()
+    from hiddifypanel.base import create_app
+    app = create_app()
+    app.before_first_request_funcs.clear()  # telegram bot
+    return app
+
+
+def random_wg_key():
+    return base64.b64encode(os.urandom(32)).decode()
+
+
+def populate(app, n_domains, n_proxies, n_ports, n_users):
+    from hiddifypanel.database import db
+    from hiddifypanel.models import ConfigEnum, Domain, DomainType, Proxy, User, set_hconfig, hconfig
+    from hiddifypanel.panel import hiddify
+
+    with app.app_context():
+        set_hconfig(ConfigEnum.http_ports, ",".join(str(p) for p in [80] + [8080 + i for i in range(n_ports - 1)]), commit=False)
+        set_hconfig(ConfigEnum.tls_ports, ",".join(str(p) for p in [443] + [8443 + i for i in range(n_ports - 1)]), commit=False)
+
+        modes = [DomainType.direct, DomainType.cdn, DomainType.relay]
+        for i in range(n_domains):
+            mode = modes[i % len(modes)]
+            db.session.add(Domain(domain=f'd{i}.bench.test', mode=mode, cdn_ip='' if mode == DomainType.direct else f'cdn{i}.bench.test'))
+
+        proxies = Proxy.query.order_by(Proxy.id).all()
+        for i, p in enumerate(proxies):
+            p.enable = not n_proxies or i < n_proxies
+
+        uuids = []
+        for i in range(n_users):
+            priv, publ = hiddify.get_ed25519_private_public_pair()
+            user = User(uuid=str(uuid.uuid4()), name=f'user{i}', usage_limit=100 * 1024**3, package_days=30,
+                        ed25519_private_key=priv, ed25519_public_key=publ,
+                        wg_pk=random_wg_key(), wg_pub=random_wg_key(), wg_psk=random_wg_key())
+            db.session.add(user)
+            uuids.append(user.uuid)
+        db.session.commit()
+        return {
+            'uuids': uuids,
+            'host': 'd0.bench.test',
+            'proxy_path': hconfig(ConfigEnum.proxy_path_client),
+            'enabled_proxies': Proxy.query.filter(Proxy.enable == True).count(),
+        }
+
+
+def summarize(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'p50': round(statistics.median(samples), 3),
+        'p99': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 3),
+        'max': round(samples[-1], 3),
+    }
+
+
+def bench_endpoints(app, data, n_requests, n_alloc):
+    from hiddifypanel import cache
+    from hiddifypanel.panel.user import user as user_view
+    client = app.test_client()
+    results = {}
+    for fmt, (path, ua) in FORMATS.items():
+        cold, warm, sizes = [], [], []
+        seen = set()
+        for i in range(n_requests):
+            user_uuid = data['uuids'][i % len(data['uuids'])]
+            url = f"/{data['proxy_path']}/{user_uuid}{path}"
+            start = time.perf_counter()
+            resp = client.get(url, base_url=f"https://{data['host']}", headers={'User-Agent': ua})
+            body = resp.get_data()
+            elapsed = (time.perf_counter() - start) * 1000
+            if resp.status_code != 200:
+                raise Exception(f'{url} returned {resp.status_code}: {body[:200]}')
+            (warm if user_uuid in seen else cold).append(elapsed)
+            seen.add(user_uuid)
+            sizes.append(len(body))
+
+        peaks = []
+        tracemalloc.start()
+        for i in range(n_alloc):
+            user_uuid = data['uuids'][i % len(data['uuids'])]
+            cache.redis_client.delete(user_view.rendered_subscription_key(user_uuid))
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            client.get(f"/{data['proxy_path']}/{user_uuid}{path}", base_url=f"https://{data['host']}", headers={'User-Agent': ua}).get_data()
+            peaks.append((tracemalloc.get_traced_memory()[1] - before) / 1024)
+        tracemalloc.stop()
+
+        results[fmt] = {
+            'cold_ms': summarize(cold),
+            'warm_ms': summarize(warm),
+            'peak_alloc_kib': summarize(peaks),
+            'body_bytes': summarize(sizes),
+        }
+        print(fmt, json.dumps(results[fmt]))
+    return results
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return summarize(samples)
+
+
+def bench_functions(app, data, repeat):
+    from hiddifypanel.panel.user import link_maker, user as user_view
+    user_uuid = data['uuids'][0]
+    url = f"/{data['proxy_path']}/{user_uuid}/all.txt"
+    with app.test_request_context(url, base_url=f"https://{data['host']}", headers={'User-Agent': 'v2rayNG/1.8.12'}):
+        app.preprocess_request()
+        c = user_view.get_common_data(user_uuid, 'new')
+        proxies = link_maker.get_all_validated_proxies(c['domains'])
+
+        def cold_validated_proxies():
+            link_maker.proxy_plans.clear()
+            link_maker.get_all_validated_proxies(c['domains'])
+
+        results = {
+            'get_common_data': timed(lambda: user_view.get_common_data(user_uuid, 'new'), repeat),
+            'get_all_validated_proxies': timed(lambda: link_maker.get_all_validated_proxies(c['domains']), repeat),
+            'get_all_validated_proxies_cold': timed(cold_validated_proxies, repeat),
+            'to_link': timed(lambda: [link_maker.to_link(p) for p in proxies], repeat),
+            'to_clash': timed(lambda: [link_maker.to_clash(p, 'meta') for p in proxies], repeat),
+            'to_singbox': timed(lambda: [link_maker.to_singbox(p) for p in proxies], repeat),
+            'make_full_singbox_config': timed(lambda: link_maker.make_full_singbox_config(**c), repeat),
+        }
+        results['proxies_per_user'] = len(proxies)
+    for name, res in results.items():
+        print(name, json.dumps(res))
+    return results
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    for section in ['endpoints', 'functions']:
+        for name, res in new.get(section, {}).items():
+            old_res = old.get(section, {}).get(name)
+            if not isinstance(res, dict) or not isinstance(old_res, dict):
+                continue
+            for metric, values in res.items():
+                if not isinstance(values, dict) or not isinstance(old_res.get(metric), dict):
+                    continue
+                o, n = old_res[metric]['p50'], values['p50']
+                change = f'{(n - o) / o * 100:+.1f}%' if o else '-'
+                print(f'{section:10} {name:32} {metric:15} p50 {o:>10} -> {n:>10} {change}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--domains', type=int, default=5)
+    parser.add_argument('--proxies', type=int, default=0, help='number of enabled proxies, 0 means all the defaults')
+    parser.add_argument('--ports', type=int, default=2, help='number of http and of tls ports')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=100, help='requests per format')
+    parser.add_argument('--allocations', type=int, default=10, help='requests per format measured with tracemalloc')
+    parser.add_argument('--repeat', type=int, default=20, help='calls per function')
+    parser.add_argument('-o', '--output', default=None)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+    if args.compare:
+        return compare(*args.compare)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        app = setup_app(workdir)
+        data = populate(app, args.domains, args.proxies, args.ports, args.users)
+        endpoints = bench_endpoints(app, data, args.requests, args.allocations)
+        functions = bench_functions(app, data, args.repeat)
+
+    import hiddifypanel
+    result = {
+        'version': hiddifypanel.__version__,
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'params': {'domains': args.domains, 'proxies': data['enabled_proxies'], 'ports': args.ports, 'users': args.users,
+                   'requests': args.requests, 'allocations': args.allocations, 'repeat': args.repeat},
+        'endpoints': endpoints,
+        'functions': functions,
+    }
+    output = args.output or f'benchmark-{hiddifypanel.__version__}.json'
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f'saved in {output}')
+
+
+if __name__ == "__main__":
+    main()